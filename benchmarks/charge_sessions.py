@@ -0,0 +1,95 @@
+"""Test de charge de la couche d'accès aux données de mini_crm.py.
+
+Simule N sessions Streamlit concurrentes. Chaque "rerun" simulé utilise la session
+du thread (scoped_session), lit une page du tableau de bord, compte les résultats
+d'une recherche, modifie parfois un statut, puis libère la session comme main().
+
+    python benchmarks/charge_sessions.py --sessions 1,4,16,32 --duree 10
+    python benchmarks/charge_sessions.py --db-url postgresql://... --clients 0
+
+Sort avec le code 1 si une erreur survient pendant la charge.
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+from commun import peupler
+
+RECHERCHES = ["", "", "dupont", "lyon", "sarl", "06"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", help="base cible (défaut : SQLite temporaire)")
+    parser.add_argument("--clients", type=int, default=2000, help="clients à créer avant la charge")
+    parser.add_argument("--sessions", default="1,2,4,8,16", help="niveaux de concurrence, séparés par des virgules")
+    parser.add_argument("--duree", type=float, default=5.0, help="durée de chaque palier (secondes)")
+    parser.add_argument("--ecritures", type=float, default=0.1, help="part des reruns qui modifient un statut")
+    return parser.parse_args()
+
+
+def palier(crm, nb_sessions, duree, part_ecritures, ids):
+    latences, erreurs = [], []
+    verrou = threading.Lock()
+    fin = time.monotonic() + duree
+
+    def utilisateur():
+        rng = random.Random()
+        while time.monotonic() < fin:
+            debut = time.perf_counter()
+            try:
+                recherche = rng.choice(RECHERCHES)
+                crm.get_dataframe(recherche, page=rng.randint(1, 5), taille_page=50)
+                crm.compter_clients(recherche)
+                if ids and rng.random() < part_ecritures:
+                    crm.modifier_client(rng.choice(ids), {"statut": rng.choice(crm.STATUTS)})
+            except Exception as e:
+                crm.session.rollback()
+                with verrou: erreurs.append(repr(e))
+            finally:
+                crm.fin_de_rerun()
+            with verrou: latences.append(time.perf_counter() - debut)
+
+    threads = [threading.Thread(target=utilisateur) for _ in range(nb_sessions)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return latences, erreurs
+
+
+def main():
+    args = parse_args()
+    if args.db_url:
+        os.environ["CRM_SUPABASE_DB_URL"] = args.db_url
+    else:
+        os.environ["CRM_SUPABASE_DB_URL"] = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "charge.db")
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import mini_crm as crm
+
+    crm.initialiser_base()
+    if args.clients: peupler(crm, 0, args.clients)
+    ids = [i for (i,) in crm.session.query(crm.ClientModel.id).all()]
+    crm.fin_de_rerun()
+    pool = crm.get_engine().pool
+    print(f"Base : {crm.get_engine().url.render_as_string(hide_password=True)} — {len(ids)} clients — pool : {pool.status()}")
+
+    print(f"{'sessions':>8} {'reruns/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'erreurs':>8}")
+    total_erreurs = []
+    for nb in [int(n) for n in args.sessions.split(",")]:
+        latences, erreurs = palier(crm, nb, args.duree, args.ecritures, ids)
+        total_erreurs += erreurs
+        latences.sort()
+        p95 = latences[int(len(latences) * 0.95) - 1] if latences else 0
+        print(f"{nb:>8} {len(latences) / args.duree:>10.1f} {statistics.median(latences) * 1000 if latences else 0:>8.1f} {p95 * 1000:>8.1f} {len(erreurs):>8}")
+
+    for e in sorted(set(total_erreurs))[:10]:
+        print("  erreur :", e)
+    return 1 if total_erreurs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
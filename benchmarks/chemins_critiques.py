@@ -0,0 +1,238 @@
+"""Benchmark hors-ligne des chemins critiques de mini_crm.py.
+
+Base SQLite temporaire (ou --db-url vers un Postgres local), stockage StockageLocal
+servi par un serveur HTTP local, API SIRET remplacée par un bouchon sur ce même
+serveur : aucune dépendance à Supabase ni au réseau.
+
+Pour chaque taille de base (--tailles), mesure sur --repetitions appels :
+  get_dataframe (page simple, puis avec recherche), changer_statuts par lots
+  (chemin d'update_from_editor), fetch_siret_data et resoudre_sirets (cache vide), sauvegarder_fichiers,
+  generer_pdf_fusionne (PDF + JPEG, cache froid puis chaud), supprimer_client_entier.
+Rapporte p50/p95/p99, nombre de requêtes SQL et pic mémoire (tracemalloc, process
+principal seulement).
+
+    python benchmarks/chemins_critiques.py --tailles 1000,10000 --enregistrer reference.json
+    python benchmarks/chemins_critiques.py --tailles 1000,10000 --reference reference.json --seuil 0.25
+
+Sort avec le code 1 si une mesure régresse au-delà du seuil par rapport à la référence
+(temps p50 ou mémoire au-delà de +seuil, ou requêtes SQL plus nombreuses).
+"""
+import argparse
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+from commun import peupler
+
+RECHERCHES = ["dupont12", "lyon", "sarl test 7", "0600001"]
+TOLERANCE_MS = 2.0  # En dessous, un écart de temps est du bruit
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--db-url", help="base cible, vidée au préalable : ne pas viser une base de production (défaut : SQLite temporaire)")
+    parser.add_argument("--tailles", default="1000,10000", help="nombres de clients, séparés par des virgules")
+    parser.add_argument("--repetitions", type=int, default=20, help="appels mesurés par scénario")
+    parser.add_argument("--fichiers", type=int, default=6, help="fichiers par dossier (moitié PDF, moitié JPEG)")
+    parser.add_argument("--lot-statuts", type=int, default=50, help="lignes modifiées par lot de changer_statuts")
+    parser.add_argument("--reference", help="JSON de référence à comparer")
+    parser.add_argument("--seuil", type=float, default=0.25, help="régression tolérée (0.25 = +25 %%)")
+    parser.add_argument("--enregistrer", help="écrit les résultats dans ce JSON (nouvelle référence)")
+    parser.add_argument("--graine", type=int, default=42)
+    return parser.parse_args()
+
+
+class Bouchons(SimpleHTTPRequestHandler):
+    """Sert le dossier du stockage local, et /siret comme l'API recherche-entreprises."""
+    def do_GET(self):
+        if not self.path.startswith("/siret"): return super().do_GET()
+        siret = self.path.split("q=", 1)[-1][:14]
+        corps = json.dumps({"results": [{"nom_complet": f"ENTREPRISE {siret}", "siege": {"adresse": f"{siret[-3:]} rue du Test 69000 Lyon"}}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corps)))
+        self.end_headers()
+        self.wfile.write(corps)
+
+    def log_message(self, *args):
+        pass
+
+
+def demarrer_bouchons(dossier):
+    serveur = ThreadingHTTPServer(("127.0.0.1", 0), partial(Bouchons, directory=dossier))
+    threading.Thread(target=serveur.serve_forever, daemon=True).start()
+    return serveur
+
+
+def fichier_memoire(nom, data, content_type):
+    fichier = io.BytesIO(data)
+    fichier.name, fichier.type = nom, content_type
+    return fichier
+
+
+def generer_fichiers(rng, nombre):
+    """Fichiers au contenu unique (pas de déduplication) : moitié PDF, moitié JPEG."""
+    from PIL import Image
+    fichiers = []
+    for i in range(nombre):
+        image = Image.effect_noise((1600, 1200), rng.randint(20, 80)).convert("RGB")
+        sortie = io.BytesIO()
+        if i % 2:
+            image.save(sortie, "JPEG", quality=85)
+            fichiers.append(fichier_memoire(f"photo_{i}.jpg", sortie.getvalue(), "image/jpeg"))
+        else:
+            image.save(sortie, "PDF")
+            fichiers.append(fichier_memoire(f"devis_{i}.pdf", sortie.getvalue(), "application/pdf"))
+    return fichiers
+
+
+def nouveau_client(crm, nom):
+    return crm.ajouter_client(dict(nom=nom, prenom=None, entreprise="Bench", siret=None, adresse_kbis=None, adresse_travaux=None,
+                                   email=None, telephone=None, nb_eclairage=10, nb_leds_preconise=8, note=None,
+                                   superficie_m2=None, hauteur_m=None, type_eclairage=None, puissance_w=58))
+
+
+def percentile(valeurs, p):
+    valeurs = sorted(valeurs)
+    return valeurs[min(len(valeurs) - 1, max(0, round(p / 100 * len(valeurs)) - 1))]
+
+
+def mesurer(crm, compteur, repetitions, preparer, appel):
+    """preparer() (non chronométré) renvoie les arguments d'appel(*args). Dernier appel sous tracemalloc."""
+    durees, requetes = [], []
+    for i in range(repetitions + 1):
+        args = preparer()
+        crm.fin_de_rerun()
+        avant = compteur[0]
+        if i == repetitions:
+            tracemalloc.start()
+            base = tracemalloc.get_traced_memory()[0]
+        debut = time.perf_counter()
+        try: appel(*args)
+        finally:
+            duree = time.perf_counter() - debut
+            if i == repetitions:
+                pic = tracemalloc.get_traced_memory()[1] - base
+                tracemalloc.stop()
+            crm.fin_de_rerun()
+        if i < repetitions:
+            durees.append(duree)
+            requetes.append(compteur[0] - avant)
+    return {"p50_ms": percentile(durees, 50) * 1000, "p95_ms": percentile(durees, 95) * 1000,
+            "p99_ms": percentile(durees, 99) * 1000, "requetes": statistics.median(requetes), "memoire_mo": pic / 2 ** 20}
+
+
+def scenarios(crm, args, rng, ids):
+    pdf_dossier = crm.PDF_DOSSIER
+    dossier = nouveau_client(crm, "Dossier PDF")
+    crm.sauvegarder_fichiers(dossier, generer_fichiers(rng, args.fichiers), "Devis Signé")
+    crm.fin_de_rerun()
+
+    def vider_cache_pdf():
+        shutil.rmtree(pdf_dossier, ignore_errors=True)
+        return (dossier,)
+
+    def client_avec_fichiers():
+        client_id = nouveau_client(crm, "A supprimer")
+        crm.sauvegarder_fichiers(client_id, generer_fichiers(rng, args.fichiers), "Photos Local")
+        return (client_id,)
+
+    def lot_statuts():
+        return ({i: rng.choice(crm.STATUTS) for i in rng.sample(ids, min(args.lot_statuts, len(ids)))},)
+
+    cible_upload = nouveau_client(crm, "Cible upload")
+    return [
+        ("get_dataframe", lambda: ("", rng.randint(1, 20), 50), crm.get_dataframe),
+        ("get_dataframe (recherche)", lambda: (rng.choice(RECHERCHES), 1, 50), crm.get_dataframe),
+        (f"changer_statuts (lot de {args.lot_statuts})", lot_statuts, crm.changer_statuts),
+        ("fetch_siret_data (cache vide)", lambda: (str(rng.randrange(10 ** 13, 10 ** 14)),), crm.fetch_siret_data),
+        (f"resoudre_sirets (lot de {args.lot_statuts}, cache vide)",
+         lambda: ([str(rng.randrange(10 ** 13, 10 ** 14)) for _ in range(args.lot_statuts)],), crm.resoudre_sirets),
+        (f"sauvegarder_fichiers ({args.fichiers} fichiers)", lambda: (cible_upload, generer_fichiers(rng, args.fichiers), "Photos Local"), crm.sauvegarder_fichiers),
+        ("generer_pdf_fusionne (froid)", vider_cache_pdf, crm.generer_pdf_fusionne),
+        ("generer_pdf_fusionne (cache)", lambda: (dossier,), crm.generer_pdf_fusionne),
+        (f"supprimer_client_entier ({args.fichiers} fichiers)", client_avec_fichiers, crm.supprimer_client_entier),
+    ]
+
+
+def comparer(resultats, reference, seuil):
+    regressions = []
+    for cle, mesure in resultats.items():
+        ref = reference.get(cle)
+        if not ref: continue
+        if mesure["p50_ms"] > ref["p50_ms"] * (1 + seuil) and mesure["p50_ms"] - ref["p50_ms"] > TOLERANCE_MS:
+            regressions.append(f"{cle} : p50 {mesure['p50_ms']:.1f} ms (référence {ref['p50_ms']:.1f} ms)")
+        if mesure["requetes"] > ref["requetes"]:
+            regressions.append(f"{cle} : {mesure['requetes']:g} requêtes SQL (référence {ref['requetes']:g})")
+        if mesure["memoire_mo"] > ref["memoire_mo"] * (1 + seuil) and mesure["memoire_mo"] - ref["memoire_mo"] > 1:
+            regressions.append(f"{cle} : pic mémoire {mesure['memoire_mo']:.1f} Mo (référence {ref['memoire_mo']:.1f} Mo)")
+    return regressions
+
+
+def main():
+    args = parse_args()
+    dossier = tempfile.mkdtemp(prefix="crm_bench_")
+    stockage = os.path.join(dossier, "stockage")
+    os.makedirs(stockage)
+    serveur = demarrer_bouchons(stockage)
+    url = f"http://127.0.0.1:{serveur.server_address[1]}"
+    os.environ.update({
+        "CRM_SUPABASE_DB_URL": args.db_url or "sqlite:///" + os.path.join(dossier, "bench.db"),
+        "CRM_STORAGE_BACKEND": "local", "CRM_STORAGE_LOCAL_DIR": stockage, "CRM_STORAGE_LOCAL_URL": url,
+        "CRM_SIRET_API_URL": f"{url}/siret", "CRM_SIRET_REQUETES_PAR_SECONDE": "100000",
+        "CRM_PDF_DOSSIER": os.path.join(dossier, "pdf"),
+    })
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import mini_crm as crm
+    from sqlalchemy import event
+
+    if args.db_url:
+        crm.Base.metadata.drop_all(crm.get_engine())
+    crm.migrer()
+    compteur = [0]
+    event.listen(crm.get_engine(), "before_cursor_execute", lambda *a: compteur.__setitem__(0, compteur[0] + 1))
+    rng = random.Random(args.graine)
+    print(f"Base : {crm.get_engine().url.render_as_string(hide_password=True)} — stockage et SIRET : {url}")
+
+    resultats, nb_clients = {}, 0
+    for taille in [int(t) for t in args.tailles.split(",")]:
+        if taille > nb_clients:
+            peupler(crm, nb_clients, taille)
+            nb_clients = taille
+        ids = [i for (i,) in crm.session.query(crm.ClientModel.id).all()]
+        crm.fin_de_rerun()
+        print(f"\n{taille} clients")
+        print(f"  {'scénario':<40} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'requêtes':>9} {'mémoire Mo':>11}")
+        for nom, preparer, appel in scenarios(crm, args, rng, ids):
+            mesure = mesurer(crm, compteur, args.repetitions, preparer, appel)
+            resultats[f"{taille}/{nom}"] = mesure
+            print(f"  {nom:<40} {mesure['p50_ms']:>9.1f} {mesure['p95_ms']:>9.1f} {mesure['p99_ms']:>9.1f} {mesure['requetes']:>9g} {mesure['memoire_mo']:>11.1f}")
+
+    erreurs_kpi = crm.verifier_kpi()
+    crm.fin_de_rerun()
+    serveur.shutdown()
+    shutil.rmtree(dossier, ignore_errors=True)
+    if erreurs_kpi: print(f"\nSynthèse KPI incohérente après le benchmark : {erreurs_kpi[:5]}")
+
+    if args.enregistrer:
+        with open(args.enregistrer, "w") as f: json.dump(resultats, f, indent=2, ensure_ascii=False)
+    regressions = []
+    if args.reference:
+        with open(args.reference) as f: regressions = comparer(resultats, json.load(f), args.seuil)
+        print(f"\n{len(regressions)} régression(s) par rapport à {args.reference} (seuil +{args.seuil:.0%})")
+        for r in regressions: print("  " + r)
+    return 1 if regressions or erreurs_kpi else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
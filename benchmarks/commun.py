@@ -0,0 +1,22 @@
+"""Données de test partagées par les benchmarks (mini_crm est passé en argument :
+chaque script le configure par variables d'environnement avant de l'importer)."""
+from types import SimpleNamespace
+
+VILLES = ["Lyon", "Paris", "Marseille", "Lille", "Nantes"]
+
+
+def peupler(crm, debut, fin, taille_lot=5000):
+    """Insère les clients debut..fin-1 par INSERT groupés, puis reconstruit la synthèse KPI."""
+    lignes = [{
+        "nom": f"Dupont{i}", "prenom": "Jean", "entreprise": f"SARL Test {i % 50}",
+        "adresse_travaux": f"{i} rue de la Paix, {VILLES[i % len(VILLES)]}", "telephone": f"06{i:08d}",
+        "statut": crm.STATUTS[i % len(crm.STATUTS)], "nb_eclairage": i % 40, "nb_leds_preconise": i % 30,
+        "superficie_m2": float(100 + i % 900), "puissance_w": 36 + i % 100,
+    } for i in range(debut, fin)]
+    for ligne in lignes:
+        ligne["search_document"] = crm.document_recherche(SimpleNamespace(**{c: ligne.get(c) for c in crm.CHAMPS_RECHERCHE}))
+    for i in range(0, len(lignes), taille_lot):
+        crm.session.execute(crm.ClientModel.__table__.insert(), lignes[i:i + taille_lot])
+    crm.session.commit()
+    crm.reconstruire_kpi()
+    crm.fin_de_rerun()
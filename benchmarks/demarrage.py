@@ -0,0 +1,97 @@
+"""Temps de démarrage de mini_crm.py : import à froid, premier rendu, reruns suivants.
+
+Chaque mesure tourne dans un interpréteur neuf (cache de modules vide), sur une base
+SQLite temporaire déjà migrée et le stockage local : rien ne sort sur le réseau.
+
+    python benchmarks/demarrage.py --repetitions 5
+    python benchmarks/demarrage.py --sortie demarrage.json   # pour comparer d'une version à l'autre
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+RACINE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES_LOURDS = ["pandas", "PIL", "pypdf", "supabase", "openpyxl"]
+
+MESURE_IMPORT = """
+import sys, time, json
+debut = time.perf_counter()
+import mini_crm
+duree = time.perf_counter() - debut
+print(json.dumps({"import": duree, "charges": [m for m in %r if m in sys.modules]}))
+"""
+
+MESURE_RENDU = """
+import time, json, warnings
+warnings.filterwarnings("ignore")
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("mini_crm.py", default_timeout=120)
+debut = time.perf_counter(); at.run(); premier = time.perf_counter() - debut
+debut = time.perf_counter(); at.run(); suivant = time.perf_counter() - debut
+print(json.dumps({"premier_rendu": premier, "rerun": suivant, "erreurs": [str(e.value) for e in at.exception]}))
+"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repetitions", type=int, default=3, help="processus lancés par mesure")
+    parser.add_argument("--sortie", help="écrit les médianes dans ce fichier JSON")
+    return parser.parse_args()
+
+
+def executer(code, env):
+    resultat = subprocess.run([sys.executable, "-c", code], cwd=RACINE, env=env, capture_output=True, text=True)
+    if resultat.returncode != 0:
+        sys.exit(f"Échec de la mesure :\n{resultat.stderr[-2000:]}")
+    return json.loads(resultat.stdout.strip().splitlines()[-1])
+
+
+def imports_les_plus_lents(env, nombre=8):
+    # -X importtime : temps cumulé (µs) par module importé, sur stderr
+    resultat = subprocess.run([sys.executable, "-X", "importtime", "-c", "import mini_crm"], cwd=RACINE, env=env, capture_output=True, text=True)
+    lignes = []
+    for ligne in resultat.stderr.splitlines():
+        if not ligne.startswith("import time:") or "cumulative" in ligne: continue
+        _, cumul, module = (champ.strip() for champ in ligne[len("import time:"):].split("|"))
+        if not module.startswith(" "): lignes.append((int(cumul), module.strip()))
+    return sorted(lignes, reverse=True)[:nombre]
+
+
+def main():
+    args = parse_args()
+    dossier = tempfile.mkdtemp()
+    env = dict(os.environ, CRM_SUPABASE_DB_URL="sqlite:///" + os.path.join(dossier, "demarrage.db"),
+               CRM_STORAGE_BACKEND="local", CRM_STORAGE_LOCAL_DIR=os.path.join(dossier, "stockage"))
+    subprocess.run([sys.executable, "crm_admin.py", "migrate"], cwd=RACINE, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    imports = [executer(MESURE_IMPORT % MODULES_LOURDS, env) for _ in range(args.repetitions)]
+    rendus = [executer(MESURE_RENDU, env) for _ in range(args.repetitions)]
+    erreurs = sorted({e for r in rendus for e in r["erreurs"]})
+
+    medianes = {
+        "import_ms": statistics.median(r["import"] for r in imports) * 1000,
+        "premier_rendu_ms": statistics.median(r["premier_rendu"] for r in rendus) * 1000,
+        "rerun_ms": statistics.median(r["rerun"] for r in rendus) * 1000,
+        "modules_charges": imports[0]["charges"],
+    }
+    print(f"Import de mini_crm      : {medianes['import_ms']:8.0f} ms (médiane sur {args.repetitions})")
+    print(f"Premier rendu (à froid) : {medianes['premier_rendu_ms']:8.0f} ms")
+    print(f"Rerun suivant           : {medianes['rerun_ms']:8.0f} ms")
+    print(f"Modules lourds chargés à l'import : {', '.join(medianes['modules_charges']) or 'aucun'}")
+    print("Imports les plus coûteux (cumul) :")
+    for cumul, module in imports_les_plus_lents(env):
+        print(f"  {cumul / 1000:8.1f} ms  {module}")
+    for e in erreurs:
+        print("  erreur au rendu :", e)
+
+    if args.sortie:
+        with open(args.sortie, "w") as f: json.dump(medianes, f, indent=2)
+    return 1 if erreurs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
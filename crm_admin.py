@@ -0,0 +1,70 @@
+"""Commandes d'administration du CRM, hors interface Streamlit.
+
+    python crm_admin.py migrate        # applique les migrations de schéma en attente (au déploiement)
+    python crm_admin.py kpi-check      # compare la synthèse KPI à un recalcul complet
+    python crm_admin.py kpi-rebuild    # reconstruit la synthèse KPI depuis la table clients
+    python crm_admin.py storage-purge  # supprime du bucket les objets en attente de suppression
+    python crm_admin.py storage-reconcile  # planifie puis purge les objets du bucket non référencés
+
+La base est celle de .streamlit/secrets.toml (ou de CRM_SUPABASE_DB_URL).
+"""
+import argparse
+import sys
+
+import mini_crm as crm
+
+
+def migrate(args):
+    print(f"Schéma en version {crm.version_schema()}.")
+    appliquees = crm.migrer(sortie=print)
+    print(f"{len(appliquees)} migration(s) appliquée(s), schéma en version {crm.version_schema()}.")
+    return 0
+
+
+def kpi_check(args):
+    ecarts = crm.verifier_kpi()
+    for statut, colonne, stocke, attendu in ecarts:
+        print(f"{statut:<15} {colonne:<22} stocké={stocke:<12g} attendu={attendu:g}")
+    print("KPI cohérents." if not ecarts else f"{len(ecarts)} écart(s).")
+    return 1 if ecarts else 0
+
+
+def kpi_rebuild(args):
+    crm.reconstruire_kpi()
+    print("Synthèse KPI reconstruite.")
+    return 0
+
+
+def storage_purge(args):
+    resultat = crm.purger_suppressions()
+    print(f"{resultat['supprimes']} objet(s) supprimé(s), {resultat['echecs']} en échec (nouvel essai plus tard).")
+    return 1 if resultat["echecs"] else 0
+
+
+def storage_reconcile(args):
+    resultat = crm.reconcilier_stockage()
+    print(f"{resultat['objets']} objet(s) dans le bucket, {resultat['orphelins']} orphelin(s).")
+    return 1 if resultat.get("echecs") else 0
+
+
+COMMANDES = {"migrate": migrate, "kpi-check": kpi_check, "kpi-rebuild": kpi_rebuild, "storage-purge": storage_purge, "storage-reconcile": storage_reconcile}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("commande", choices=COMMANDES)
+    args = parser.parse_args()
+    if not crm.DATABASE_URL:
+        print("Base introuvable : renseigner .streamlit/secrets.toml ou CRM_SUPABASE_DB_URL.", file=sys.stderr)
+        return 2
+    try:
+        if args.commande != "migrate": crm.initialiser_base()
+        return COMMANDES[args.commande](args)
+    except crm.SchemaNonAJour as e:
+        print(e, file=sys.stderr)
+        return 2
+    finally: crm.fin_de_rerun()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
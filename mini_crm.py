@@ -1,29 +1,94 @@
 import streamlit as st
-from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey
-from sqlalchemy.orm import sessionmaker, declarative_base, relationship
+from sqlalchemy import create_engine, Column, Integer, String, Text, ForeignKey, Float, Boolean, DateTime, func, event, inspect, text, insert, case, select, literal_column
+from sqlalchemy.dialects.postgresql import insert as insert_postgresql
+from sqlalchemy.dialects.sqlite import insert as insert_sqlite
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import sessionmaker, scoped_session, declarative_base, relationship, selectinload
+from sqlalchemy.pool import NullPool
 import pandas as pd
 import json
+import uuid
+import logging
+import hmac
+import csv
+from datetime import datetime, timedelta, timezone
 import requests
+from requests.adapters import HTTPAdapter
 import re
-import io
 import unicodedata
-from supabase import create_client, Client
-from PIL import Image
-from pypdf import PdfWriter, PdfReader
-
-# --- CONFIGURATION SUPABASE ---
-try:
-    SUPABASE_URL = st.secrets["supabase"]["url"]
-    SUPABASE_KEY = st.secrets["supabase"]["key"]
-    DATABASE_URL = st.secrets["supabase"]["db_url"].replace("postgres://", "postgresql://")
-except FileNotFoundError:
-    st.error("Secrets introuvables.")
-    st.stop()
-
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+import threading
+import time
+import os
+import tempfile
+import hashlib
+import glob
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict, deque
+from contextlib import contextmanager, nullcontext
+from types import SimpleNamespace
+from traitement_images import est_image, normaliser_image
+
+# --- CONFIGURATION ---
+def _conf(section, cle, defaut):
+    # Paramètre de secrets.toml, sinon variable d'environnement CRM_<SECTION>_<CLE>, sinon défaut
+    try: return st.secrets[section][cle]
+    except Exception: return os.environ.get(f"CRM_{section}_{cle}".upper(), defaut)
+
+def _conf_bool(section, cle, defaut):
+    return str(_conf(section, cle, defaut)).lower() in ("1", "true", "oui", "yes")
+
+SUPABASE_URL = _conf("supabase", "url", None)
+SUPABASE_KEY = _conf("supabase", "key", None)
+DATABASE_URL = (_conf("supabase", "db_url", None) or "").replace("postgres://", "postgresql://")
+
+TAILLES_PAGE = [25, 50, 100, 200]
+TAILLE_PAGE_DEFAUT = int(_conf("app", "taille_page", 50))
+CACHE_TAILLE_MAX = int(_conf("app", "cache_taille", 256))
+UPLOAD_WORKERS = int(_conf("upload", "workers", 6))
+UPLOAD_TENTATIVES = int(_conf("upload", "tentatives", 3))
+PDF_WORKERS = int(_conf("pdf", "workers", 4))
+PDF_SPOOL_MAX = int(_conf("pdf", "spool_max_mo", 8)) * 1024 * 1024
+PDF_SPOOL_TOTAL = int(_conf("pdf", "spool_total_mo", 32)) * 1024 * 1024  # Tous téléchargements en cours confondus
+PDF_DOSSIER = _conf("pdf", "dossier", os.path.join(tempfile.gettempdir(), "crm_dossiers"))
+PDF_CACHE_MAX = int(_conf("pdf", "cache_max_mo", 500)) * 1024 * 1024
+IMAGE_TAILLE_MAX = int(_conf("images", "taille_max", 2000))
+IMAGE_QUALITE = int(_conf("images", "qualite", 82))
+IMAGE_MINIATURE = int(_conf("images", "miniature", 256))
+IMAGE_WORKERS = int(_conf("images", "workers", 2))
+SIRET_API_URL = _conf("siret", "api_url", "https://recherche-entreprises.api.gouv.fr/search")
+SIRET_TTL = timedelta(days=int(_conf("siret", "ttl_jours", 30)))
+SIRET_TTL_NEGATIF = timedelta(hours=int(_conf("siret", "ttl_negatif_heures", 24)))
+SIRET_WORKERS = int(_conf("siret", "workers", 4))
+SIRET_DEBIT_MAX = float(_conf("siret", "requetes_par_seconde", 7))
+PUISSANCE_LED_W = float(_conf("kpi", "puissance_led_w", 40))  # Puissance estimée d'une LED préconisée
+JOBS_WORKERS = int(_conf("jobs", "workers", 2))
+JOBS_RAFRAICHISSEMENT = float(_conf("jobs", "rafraichissement_s", 2))
+JOBS_RETENTION = timedelta(days=float(_conf("jobs", "retention_jours", 7)))  # Jobs terminés conservés avant nettoyage
+PURGE_INTERVALLE = int(_conf("storage", "purge_intervalle_s", 300))
+PURGE_LOT = 500
+RECONCILIATION_INTERVALLE = timedelta(hours=float(_conf("storage", "reconciliation_heures", 24)))  # 0 = désactivée
+RECONCILIATION_GRACE = timedelta(hours=float(_conf("storage", "grace_heures", 1)))
+PERF_ACTIF = _conf_bool("perf", "enabled", False)
+PERF_SEUIL_LENT_MS = float(_conf("perf", "slow_query_ms", 200))
+PERF_HISTORIQUE = int(_conf("perf", "historique", 20))
+PERF_EXPORT = _conf("perf", "export_fichier", None)  # .json ou .prom (collecteur textfile de node_exporter)
+PERF_CODE_ADMIN = _conf("perf", "code_admin", None)  # Panneau Performances affiché avec ?admin=<code> dans l'URL
+DB_POOL_SIZE = int(_conf("db", "pool_size", 5))
+DB_MAX_OVERFLOW = int(_conf("db", "max_overflow", 5))
+DB_POOL_TIMEOUT = int(_conf("db", "pool_timeout", 30))
+DB_POOL_RECYCLE = int(_conf("db", "pool_recycle", 1800))
+DB_PRE_PING = _conf_bool("db", "pre_ping", True)
+DB_NULL_POOL = _conf_bool("db", "null_pool", False)
+DB_MIGRATIONS_AUTO = _conf_bool("db", "migrations_auto", True)
+
 BUCKET_NAME = "fichiers_clients"
-engine = create_engine(DATABASE_URL, echo=False)
+STATUTS = ["Nouveau", "Contacté", "Devis envoyé", "En négo", "Signé", "Perdu"]
+CATEGORIES = ["Devis Signé", "Captures Géoportail", "Photos Local", "Pièces Supplémentaires"]  # Ordre d'affichage et de fusion
+CATEGORIES_REQUISES = {"Devis Signé", "Captures Géoportail", "Photos Local"}
+TAILLE_PAGE_SELECTEUR = int(_conf("app", "taille_page_selecteur", 100))
 Base = declarative_base()
+journal = logging.getLogger("mini_crm")
 
 # --- MODELES ---
 class ClientModel(Base):
@@ -39,9 +104,14 @@ class ClientModel(Base):
     telephone = Column(String, nullable=True)
     statut = Column(String, default="Nouveau")
     note = Column(Text, nullable=True)
-    nb_eclairage = Column(String, nullable=True)
-    nb_leds_preconise = Column(String, nullable=True)
-    caracteristiques_json = Column(Text, nullable=True)
+    nb_eclairage = Column(Integer, nullable=True)
+    nb_leds_preconise = Column(Integer, nullable=True)
+    superficie_m2 = Column(Float, nullable=True)
+    hauteur_m = Column(Float, nullable=True)
+    type_eclairage = Column(String, nullable=True)
+    puissance_w = Column(Integer, nullable=True)
+    caracteristiques_json = Column(Text, nullable=True)  # Ancien format, lu uniquement par migrer_caracteristiques()
+    search_document = Column(Text, nullable=True)
     fichiers = relationship("FichierClientModel", back_populates="client", cascade="all, delete-orphan")
 
 class FichierClientModel(Base):
@@ -52,175 +122,1339 @@ class FichierClientModel(Base):
     categorie = Column(String)
     path_storage = Column(String)
     url_public = Column(String)
+    path_miniature = Column(String, nullable=True)
+    url_miniature = Column(String, nullable=True)
+    hash_contenu = Column(String, nullable=True, index=True)  # SHA-256 du fichier envoyé (NULL : fichiers antérieurs)
     client = relationship("ClientModel", back_populates="fichiers")
 
-Base.metadata.create_all(engine)
-Session = sessionmaker(bind=engine)
-session = Session()
+class EntrepriseCacheModel(Base):
+    # Résultats de l'API recherche-entreprises (trouve=False : SIRET inconnu, TTL plus court)
+    __tablename__ = 'cache_siret'
+    siret = Column(String, primary_key=True)
+    nom_complet = Column(String, nullable=True)
+    adresse = Column(String, nullable=True)
+    trouve = Column(Boolean, default=True)
+    maj_le = Column(DateTime)
+
+class KpiStatutModel(Base):
+    # Agrégats par statut, mis à jour à chaque écriture (voir appliquer_deltas_kpi)
+    __tablename__ = 'kpi_statuts'
+    statut = Column(String, primary_key=True)
+    nb_clients = Column(Integer, nullable=False, default=0)
+    nb_eclairage = Column(Integer, nullable=False, default=0)
+    nb_leds = Column(Integer, nullable=False, default=0)
+    puissance_actuelle_w = Column(Float, nullable=False, default=0)  # somme de nb_eclairage * puissance_w
+
+class HistoriqueStatutModel(Base):
+    __tablename__ = 'historique_statuts'
+    id = Column(Integer, primary_key=True)
+    client_id = Column(Integer, ForeignKey('clients.id'), index=True)
+    ancien_statut = Column(String, nullable=True)
+    nouveau_statut = Column(String)
+    change_le = Column(DateTime)
+
+class JobModel(Base):
+    # Tâches de fond (voir soumettre_job) : statut et progression lus par l'interface
+    __tablename__ = 'jobs'
+    id = Column(String, primary_key=True)
+    type = Column(String)
+    client_id = Column(Integer, nullable=True, index=True)
+    statut = Column(String, default="en_attente", index=True)  # en_attente, en_cours, termine, echec
+    progression = Column(Float, default=0)
+    message = Column(Text, nullable=True)
+    resultat = Column(Text, nullable=True)  # JSON
+    cree_le = Column(DateTime)
+    maj_le = Column(DateTime)
+
+class SuppressionEnAttenteModel(Base):
+    # Objets du bucket à supprimer, enregistrés dans la même transaction que la suppression en base
+    __tablename__ = 'suppressions_en_attente'
+    path = Column(String, primary_key=True)
+    tentatives = Column(Integer, default=0)
+    derniere_erreur = Column(Text, nullable=True)
+    prochaine_tentative = Column(DateTime, index=True)
+
+# --- MESURES ---
+class Mesures:
+    """Temps par phase (sql, stockage.*, siret.*, pdf.*) : cumuls du process et détail des derniers reruns.
+
+    Chaque thread a son rerun courant (debut/terminer) ; propager() le transmet aux pools de threads.
+    """
+    def __init__(self, historique):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.cumuls = {}  # phase -> [appels, durée totale, durée max]
+        self.reruns = deque(maxlen=historique)
+        self.lentes = deque(maxlen=historique)
+        self.nb_lentes = 0
+        self._dernier_export = 0.0
+
+    def courant(self):
+        return getattr(self._local, "rerun", None)
+
+    def debut(self, libelle):
+        self._local.rerun = {"libelle": libelle, "debut": time.time(), "t0": time.perf_counter(), "phases": {}}
+
+    def terminer(self):
+        rerun = self.courant()
+        if rerun is None: return
+        self._local.rerun = None
+        rerun["duree"] = time.perf_counter() - rerun.pop("t0")
+        self.enregistrer("rerun", rerun["duree"])
+        with self._lock: self.reruns.append(rerun)
+        if PERF_EXPORT and time.monotonic() - self._dernier_export > 15:
+            self._dernier_export = time.monotonic()
+            contenu = exporter_mesures("json" if PERF_EXPORT.endswith(".json") else "prometheus").encode()
+            _ecrire_atomique(os.path.abspath(PERF_EXPORT), lambda sortie: sortie.write(contenu))
+
+    def enregistrer(self, phase, duree):
+        rerun = self.courant()
+        with self._lock:
+            cumul = self.cumuls.setdefault(phase, [0, 0.0, 0.0])
+            cumul[0] += 1
+            cumul[1] += duree
+            cumul[2] = max(cumul[2], duree)
+            if rerun is not None:
+                detail = rerun["phases"].setdefault(phase, [0, 0.0])
+                detail[0] += 1
+                detail[1] += duree
+
+    @contextmanager
+    def chrono(self, phase):
+        debut = time.perf_counter()
+        try: yield
+        finally: self.enregistrer(phase, time.perf_counter() - debut)
+
+    def requete_lente(self, sql, duree):
+        sql = " ".join(sql.split())[:500]
+        with self._lock:
+            self.nb_lentes += 1
+            self.lentes.append({"quand": time.time(), "duree": duree, "sql": sql})
+        journal.warning("Requête SQL lente (%.0f ms) : %s", duree * 1000, sql)
+
+    def propager(self, fonction):
+        rerun = self.courant()
+        if rerun is None: return fonction
+        def avec_rerun(*args, **kwargs):
+            self._local.rerun = rerun
+            try: return fonction(*args, **kwargs)
+            finally: self._local.rerun = None
+        return avec_rerun
+
+    def instantane(self):
+        with self._lock:
+            return {"cumuls": {phase: list(c) for phase, c in self.cumuls.items()},
+                    "reruns": [dict(r, phases={p: list(d) for p, d in r["phases"].items()}) for r in self.reruns],
+                    "lentes": list(self.lentes), "nb_lentes": self.nb_lentes}
+
+@st.cache_resource
+def get_mesures():
+    return Mesures(PERF_HISTORIQUE)
+
+_SANS_MESURE = nullcontext()
+
+def chrono(phase):
+    """with chrono("pdf.fusion"): ... — contexte vide si [perf] enabled est faux."""
+    return get_mesures().chrono(phase) if PERF_ACTIF else _SANS_MESURE
+
+def propager_mesures(fonction):
+    # Rattache les mesures faites dans un pool de threads au rerun qui l'a lancé
+    return get_mesures().propager(fonction) if PERF_ACTIF else fonction
+
+def debut_mesure(libelle):
+    if PERF_ACTIF: get_mesures().debut(libelle)
+
+def installer_mesures_sql(engine, mesures):
+    @event.listens_for(engine, "before_cursor_execute")
+    def _avant_requete(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("chronos_sql", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _apres_requete(conn, cursor, statement, parameters, context, executemany):
+        duree = time.perf_counter() - conn.info["chronos_sql"].pop()
+        mesures.enregistrer("sql", duree)
+        if duree * 1000 >= PERF_SEUIL_LENT_MS: mesures.requete_lente(statement, duree)
+
+    @event.listens_for(engine, "handle_error")
+    def _erreur_requete(contexte):
+        # Requête en échec : after_cursor_execute n'est pas appelé, le chrono est retiré ici
+        # (sinon il resterait dans conn.info, qui survit au retour de la connexion dans le pool)
+        chronos = contexte.connection.info.get("chronos_sql") if contexte.connection is not None else None
+        if chronos: chronos.pop()
+
+def exporter_mesures(format="json"):
+    """Mesures du process en JSON, ou au format texte Prometheus."""
+    donnees = get_mesures().instantane()
+    if format == "json": return json.dumps(donnees, indent=2)
+    lignes = ["# HELP crm_phase_appels_total Nombre d'appels par phase.", "# TYPE crm_phase_appels_total counter"]
+    lignes += [f'crm_phase_appels_total{{phase="{p}"}} {c[0]}' for p, c in sorted(donnees["cumuls"].items())]
+    lignes += ["# HELP crm_phase_secondes_total Temps cumulé par phase.", "# TYPE crm_phase_secondes_total counter"]
+    lignes += [f'crm_phase_secondes_total{{phase="{p}"}} {c[1]:.6f}' for p, c in sorted(donnees["cumuls"].items())]
+    lignes += ["# HELP crm_phase_secondes_max Durée maximale d'un appel par phase.", "# TYPE crm_phase_secondes_max gauge"]
+    lignes += [f'crm_phase_secondes_max{{phase="{p}"}} {c[2]:.6f}' for p, c in sorted(donnees["cumuls"].items())]
+    lignes += ["# HELP crm_requetes_lentes_total Requêtes SQL au-delà du seuil.", "# TYPE crm_requetes_lentes_total counter",
+               f"crm_requetes_lentes_total {donnees['nb_lentes']}"]
+    return "\n".join(lignes) + "\n"
+
+# Colonnes du panneau : somme des phases famille.* ; ces phases ne doivent pas s'imbriquer entre elles
+FAMILLES_MESURES = ("sql", "stockage", "siret", "pdf")
+
+def est_admin_perf():
+    # Les mesures couvrent les exécutions de toutes les sessions : réservées à qui connaît [perf] code_admin
+    code = st.query_params.get("admin")
+    return bool(PERF_CODE_ADMIN and code and hmac.compare_digest(str(code), str(PERF_CODE_ADMIN)))
+
+def afficher_mesures():
+    donnees = get_mesures().instantane()
+    with st.expander(f"⏱️ Performances — {len(donnees['reruns'])} dernière(s) exécution(s)"):
+        lignes = []
+        for rerun in reversed(donnees["reruns"]):
+            ligne = {"Heure": datetime.fromtimestamp(rerun["debut"]).strftime("%H:%M:%S"), "Exécution": rerun["libelle"],
+                     "Total (ms)": round(rerun["duree"] * 1000), "Requêtes SQL": rerun["phases"].get("sql", [0])[0]}
+            for famille in FAMILLES_MESURES:
+                ligne[f"{famille} (ms)"] = round(1000 * sum(d[1] for p, d in rerun["phases"].items() if p.split(".")[0] == famille))
+            lignes.append(ligne)
+        if lignes: st.dataframe(pd.DataFrame(lignes), hide_index=True, use_container_width=True)
+        st.caption("Temps cumulés : les phases exécutées en parallèle (envois, téléchargements) peuvent dépasser le total.")
+        st.dataframe(pd.DataFrame([{"Phase": p, "Appels": c[0], "Total (ms)": round(c[1] * 1000), "Moyenne (ms)": round(c[1] * 1000 / c[0], 1),
+                                    "Max (ms)": round(c[2] * 1000, 1)} for p, c in sorted(donnees["cumuls"].items())]),
+                     hide_index=True, use_container_width=True)
+        if donnees["lentes"]:
+            st.markdown(f"**Requêtes lentes (≥ {PERF_SEUIL_LENT_MS:g} ms) : {donnees['nb_lentes']}**")
+            st.dataframe(pd.DataFrame([{"Heure": datetime.fromtimestamp(r["quand"]).strftime("%H:%M:%S"), "Durée (ms)": round(r["duree"] * 1000),
+                                        "SQL": r["sql"]} for r in reversed(donnees["lentes"])]), hide_index=True, use_container_width=True)
+        c1, c2 = st.columns(2)
+        c1.download_button("Export JSON", exporter_mesures("json"), "mesures_crm.json", "application/json")
+        c2.download_button("Export Prometheus", exporter_mesures("prometheus"), "mesures_crm.prom", "text/plain")
+
+class StockageMesure:
+    """Enveloppe d'un stockage : chaque appel est chronométré (phases stockage.*)."""
+    def __init__(self, stockage):
+        self.stockage = stockage
+
+    def upload(self, path, data, content_type):
+        with chrono("stockage.upload"): return self.stockage.upload(path, data, content_type)
+
+    def url_publique(self, path):
+        return self.stockage.url_publique(path)
+
+    def supprimer(self, paths):
+        with chrono("stockage.suppression"): return self.stockage.supprimer(paths)
+
+    def lister(self):
+        with chrono("stockage.listing"): return iter(list(self.stockage.lister()))
+
+# --- ACCES BASE ---
+def creer_engine(url):
+    """Engine avec pool paramétrable ([db] dans secrets.toml).
+
+    Compatible pgbouncer en mode transaction (pooler Supabase, port 6543) : aucune
+    requête préparée côté serveur, et null_pool = true laisse tout le pooling à pgbouncer.
+    """
+    options = {"pool_pre_ping": DB_PRE_PING}
+    if url.startswith("sqlite"):
+        options["connect_args"] = {"check_same_thread": False}
+    elif DB_NULL_POOL:
+        options["poolclass"] = NullPool
+    else:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    if url.startswith("postgresql+psycopg:"):
+        # psycopg 3 prépare les requêtes répétées : incompatible avec pgbouncer
+        options["connect_args"] = {"prepare_threshold": None}
+    return create_engine(url, **options)
+
+@st.cache_resource
+def get_engine():
+    # Un seul engine (et donc un seul pool) par process
+    engine = creer_engine(DATABASE_URL)
+    if PERF_ACTIF: installer_mesures_sql(engine, get_mesures())
+    return engine
+
+@st.cache_resource
+def get_registre_sessions():
+    return scoped_session(sessionmaker(bind=get_engine()))
+
+class _SessionCourante:
+    """Session du thread courant : une unité de travail par rerun, libérée par fin_de_rerun()."""
+    def __getattr__(self, nom):
+        return getattr(get_registre_sessions(), nom)
+
+session = _SessionCourante()
+
+def fin_de_rerun():
+    get_registre_sessions().remove()
+    if PERF_ACTIF: get_mesures().terminer()
+
+# --- MIGRATIONS ---
+class SchemaVersionModel(Base):
+    __tablename__ = 'schema_version'
+    version = Column(Integer, primary_key=True)
+    description = Column(String)
+    applique_le = Column(DateTime)
+
+class SchemaNonAJour(RuntimeError):
+    pass
+
+# Colonnes ajoutées après la création des tables (create_all ne modifie pas une table existante)
+COLONNES_AJOUTEES = [
+    ("clients", "search_document", "TEXT"),
+    ("fichiers_clients", "path_miniature", "VARCHAR"),
+    ("fichiers_clients", "url_miniature", "VARCHAR"),
+    ("clients", "superficie_m2", "FLOAT"),
+    ("clients", "hauteur_m", "FLOAT"),
+    ("clients", "type_eclairage", "VARCHAR"),
+    ("clients", "puissance_w", "INTEGER"),
+]
+INDEX_AJOUTES = [
+    ("ix_clients_statut", "clients", "statut"),
+    ("ix_clients_superficie_m2", "clients", "superficie_m2"),
+    ("ix_clients_puissance_w", "clients", "puissance_w"),
+    ("ix_fichiers_clients_client_id", "fichiers_clients", "client_id"),
+]
+# Caractéristiques techniques : clé de l'ancien JSON -> (colonne typée, conversion)
+CARACTERISTIQUES = {
+    "Superficie (m²)": ("superficie_m2", float),
+    "Hauteur (m)": ("hauteur_m", float),
+    "Type Éclairage": ("type_eclairage", str),
+    "Puissance (W)": ("puissance_w", lambda v: int(float(v))),
+}
+
+def migrer_colonnes():
+    with get_engine().begin() as conn:
+        inspecteur = inspect(conn)
+        for table, colonne, type_sql in COLONNES_AJOUTEES:
+            if colonne not in {c["name"] for c in inspecteur.get_columns(table)}:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {colonne} {type_sql}"))
+        # Compteurs autrefois stockés en texte : conversion en INTEGER (valeurs non numériques -> NULL)
+        types = {c["name"]: c["type"] for c in inspecteur.get_columns("clients")}
+        for colonne in ("nb_eclairage", "nb_leds_preconise"):
+            if isinstance(types[colonne], Integer): continue
+            if conn.dialect.name == "postgresql":
+                conn.execute(text(f"ALTER TABLE clients ALTER COLUMN {colonne} TYPE INTEGER USING "
+                                  f"CASE WHEN {colonne} ~ '^\\s*[0-9]+(\\.[0-9]+)?\\s*$' THEN round({colonne}::numeric)::integer END"))
+            elif conn.dialect.name == "sqlite":
+                # SQLite ne sait pas changer le type d'une colonne : nouvelle colonne puis recopie
+                conn.execute(text(f"ALTER TABLE clients RENAME COLUMN {colonne} TO {colonne}_texte"))
+                conn.execute(text(f"ALTER TABLE clients ADD COLUMN {colonne} INTEGER"))
+                conn.execute(text(f"UPDATE clients SET {colonne} = CAST(round(CAST({colonne}_texte AS REAL)) AS INTEGER) "
+                                  f"WHERE trim({colonne}_texte) GLOB '[0-9]*'"))
+                conn.execute(text(f"ALTER TABLE clients DROP COLUMN {colonne}_texte"))
+        for nom, table, colonne in INDEX_AJOUTES:
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS {nom} ON {table} ({colonne})"))
+
+def migrer_caracteristiques():
+    """Reprise unique de caracteristiques_json vers les colonnes typées (fiches pas encore migrées)."""
+    colonnes = [getattr(ClientModel, col) for col, _ in CARACTERISTIQUES.values()]
+    a_migrer = session.query(ClientModel).filter(ClientModel.caracteristiques_json.isnot(None), *[c.is_(None) for c in colonnes]).all()
+    for client in a_migrer:
+        try: caracs = json.loads(client.caracteristiques_json)
+        except ValueError: continue
+        for cle, (colonne, conversion) in CARACTERISTIQUES.items():
+            try:
+                if caracs.get(cle) not in (None, ""): setattr(client, colonne, conversion(caracs[cle]))
+            except (TypeError, ValueError): pass
+    session.commit()
+
+# --- RECHERCHE ---
+CHAMPS_RECHERCHE = ["nom", "prenom", "entreprise", "siret", "adresse_kbis", "adresse_travaux", "email", "telephone", "note"]
+
+def normaliser_recherche(texte):
+    # Minuscules sans accents : même normalisation côté index et côté saisie
+    texte = unicodedata.normalize('NFKD', texte or "").encode('ascii', 'ignore').decode('utf-8')
+    return " ".join(texte.lower().split())
+
+def document_recherche(client):
+    valeurs = [getattr(client, champ) for champ in CHAMPS_RECHERCHE]
+    if client.telephone: valeurs.append(re.sub(r'\D', '', client.telephone))
+    return normaliser_recherche(" ".join(str(v) for v in valeurs if v))
+
+@event.listens_for(ClientModel, "before_insert")
+@event.listens_for(ClientModel, "before_update")
+def _maj_document_recherche(mapper, connection, client):
+    client.search_document = document_recherche(client)
+
+def preparer_index_recherche():
+    """Crée l'index de recherche (migration) et renvoie le mode utilisé.
+
+    Postgres : index GIN tsvector + pg_trgm sur search_document.
+    SQLite : table FTS5 synchronisée par triggers. Sinon : LIKE sur search_document.
+    """
+    # Remplissage des fiches existantes (avant les triggers FTS)
+    a_indexer = session.query(ClientModel).filter(ClientModel.search_document.is_(None)).all()
+    for c in a_indexer:
+        c.search_document = document_recherche(c)
+    session.commit()
+
+    engine = get_engine()
+    if engine.dialect.name == "postgresql":
+        with engine.begin() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_clients_search_trgm ON clients USING gin (search_document gin_trgm_ops)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_clients_search_tsv ON clients USING gin (to_tsvector('simple', coalesce(search_document, '')))"))
+        return "postgresql"
+
+    if engine.dialect.name == "sqlite":
+        try:
+            with engine.begin() as conn:
+                existe = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'clients_fts'")).first()
+                conn.execute(text("CREATE VIRTUAL TABLE IF NOT EXISTS clients_fts USING fts5(search_document, content='clients', content_rowid='id', tokenize='unicode61 remove_diacritics 2')"))
+                conn.execute(text("CREATE TRIGGER IF NOT EXISTS clients_fts_ai AFTER INSERT ON clients BEGIN "
+                                  "INSERT INTO clients_fts(rowid, search_document) VALUES (new.id, new.search_document); END"))
+                conn.execute(text("CREATE TRIGGER IF NOT EXISTS clients_fts_ad AFTER DELETE ON clients BEGIN "
+                                  "INSERT INTO clients_fts(clients_fts, rowid, search_document) VALUES ('delete', old.id, old.search_document); END"))
+                conn.execute(text("CREATE TRIGGER IF NOT EXISTS clients_fts_au AFTER UPDATE ON clients BEGIN "
+                                  "INSERT INTO clients_fts(clients_fts, rowid, search_document) VALUES ('delete', old.id, old.search_document); "
+                                  "INSERT INTO clients_fts(rowid, search_document) VALUES (new.id, new.search_document); END"))
+                if not existe: conn.execute(text("INSERT INTO clients_fts(clients_fts) VALUES ('rebuild')"))
+            return "fts5"
+        except Exception: pass  # SQLite compilé sans FTS5
+    return "like"
+
+def detecter_mode_recherche():
+    engine = get_engine()
+    if engine.dialect.name == "postgresql": return "postgresql"
+    if engine.dialect.name == "sqlite":
+        with engine.connect() as conn:
+            if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'clients_fts'")).first(): return "fts5"
+    return "like"
+
+# Migrations versionnées : (version, description, fonction), à ajouter en fin de liste, jamais à modifier.
+# Les premières reprennent les anciennes migrations implicites, idempotentes pour les bases déjà en place.
+MIGRATIONS = [
+    (1, "tables initiales", lambda: Base.metadata.create_all(get_engine())),
+    (2, "colonnes ajoutées, compteurs en INTEGER, index", migrer_colonnes),
+    (3, "caractéristiques JSON vers colonnes typées", migrer_caracteristiques),
+    (4, "index de recherche", preparer_index_recherche),
+    (5, "synthèse KPI", lambda: reconstruire_kpi()),
+    (6, "empreinte du contenu des fichiers", lambda: migrer_hash_contenu()),
+]
+
+def migrer_hash_contenu():
+    with get_engine().begin() as conn:
+        if "hash_contenu" not in {c["name"] for c in inspect(conn).get_columns("fichiers_clients")}:
+            conn.execute(text("ALTER TABLE fichiers_clients ADD COLUMN hash_contenu VARCHAR"))
+        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_fichiers_clients_hash_contenu ON fichiers_clients (hash_contenu)"))
+
+def version_schema():
+    # Table absente : base vide ou créée avant les migrations versionnées. Une base
+    # injoignable lève son erreur au lieu de passer pour un schéma en version 0.
+    with get_engine().connect() as conn:
+        if not inspect(conn).has_table("schema_version"): return 0
+        return conn.execute(text("SELECT max(version) FROM schema_version")).scalar() or 0
+
+def migrer(sortie=None):
+    """Applique les migrations en attente, chacune enregistrée dans schema_version. Renvoie les versions appliquées."""
+    engine = get_engine()
+    SchemaVersionModel.__table__.create(engine, checkfirst=True)
+    verrou = engine.connect()
+    try:
+        if engine.dialect.name == "postgresql":
+            verrou.execute(text("SELECT pg_advisory_lock(hashtext('crm_migrations'))"))  # Un seul process migre
+        appliquees = []
+        for version, description, fonction in MIGRATIONS:
+            if version <= version_schema(): continue
+            if sortie: sortie(f"Migration {version} : {description}")
+            fonction()
+            session.add(SchemaVersionModel(version=version, description=description, applique_le=_maintenant()))
+            session.commit()
+            appliquees.append(version)
+        return appliquees
+    finally:
+        if engine.dialect.name == "postgresql": verrou.execute(text("SELECT pg_advisory_unlock(hashtext('crm_migrations'))"))
+        verrou.close()
+
+@st.cache_resource
+def initialiser_base():
+    """Une fois par process : vérifie la version du schéma et renvoie le mode de recherche.
+
+    Les migrations se lancent au déploiement (python crm_admin.py migrate) ; avec
+    [db] migrations_auto = true (défaut), l'application les applique elle-même au démarrage.
+    """
+    if version_schema() < MIGRATIONS[-1][0]:
+        if not DB_MIGRATIONS_AUTO:
+            raise SchemaNonAJour(f"Schéma en version {version_schema()}, version {MIGRATIONS[-1][0]} attendue : lancer python crm_admin.py migrate.")
+        migrer()
+    return detecter_mode_recherche()
+
+def _appliquer_recherche(query, recherche):
+    """Filtre la requête sur l'index de recherche, renvoie (query, ordre de pertinence)."""
+    termes = re.findall(r"\w+", normaliser_recherche(recherche))
+    if not termes: return query, []
+    mode = initialiser_base()
+    if mode == "postgresql":
+        # Constantes en littéraux, pas en paramètres : l'expression doit être celle de ix_clients_search_tsv
+        # (avec psycopg 3, les paramètres sont liés côté serveur et l'index ne serait plus reconnu)
+        config = literal_column("'simple'::regconfig")
+        tsv = func.to_tsvector(config, func.coalesce(ClientModel.search_document, literal_column("''")))
+        tsq = func.to_tsquery(config, " & ".join(f"{t}:*" for t in termes))
+        saisie = " ".join(termes)
+        query = query.filter(tsv.op('@@')(tsq) | ClientModel.search_document.ilike(f"%{saisie}%"))
+        return query, [(func.ts_rank(tsv, tsq) + func.similarity(ClientModel.search_document, saisie)).desc()]
+    if mode == "fts5":
+        fts = (text("SELECT rowid AS id, bm25(clients_fts) AS rang FROM clients_fts WHERE clients_fts MATCH :q")
+               .bindparams(q=" ".join(f'"{t}"*' for t in termes))
+               .columns(id=Integer, rang=Float).subquery("fts"))
+        return query.join(fts, fts.c.id == ClientModel.id), [fts.c.rang]
+    for t in termes:
+        query = query.filter(ClientModel.search_document.like(f"%{t}%"))
+    return query, []
+
+# --- CACHE DE LECTURE ---
+class CacheResultats:
+    """Cache LRU borné partagé par toutes les sessions, clé = (requête, version des données).
+
+    Chaque écriture incrémente la version : les anciennes entrées ne sont plus jamais
+    servies et sortent du cache par éviction LRU.
+    """
+    def __init__(self, taille_max):
+        self.taille_max = taille_max
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        self._entrees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lire(self, cle, calcul, *args):
+        cle = (cle, args, self.version)
+        with self._lock:
+            if cle in self._entrees:
+                self._entrees.move_to_end(cle)
+                self.hits += 1
+                return self._entrees[cle]
+            self.misses += 1
+        valeur = calcul(*args)
+        with self._lock:
+            self._entrees[cle] = valeur
+            self._entrees.move_to_end(cle)
+            while len(self._entrees) > self.taille_max:
+                self._entrees.popitem(last=False)
+        return valeur
+
+    def invalider(self):
+        with self._lock:
+            self.version += 1
+
+@st.cache_resource
+def get_cache():
+    # Un seul cache par process (survit aux reruns du script)
+    return CacheResultats(CACHE_TAILLE_MAX)
+
+def marquer_modification():
+    get_cache().invalider()
+
+# --- KPI ---
+COLONNES_KPI = ("nb_clients", "nb_eclairage", "nb_leds", "puissance_actuelle_w")
+
+def ajouter_contribution_kpi(deltas, statut, nb_eclairage, nb_leds, puissance_w, signe=1):
+    d = deltas.setdefault(statut or "Nouveau", dict.fromkeys(COLONNES_KPI, 0))
+    d["nb_clients"] += signe
+    d["nb_eclairage"] += signe * (nb_eclairage or 0)
+    d["nb_leds"] += signe * (nb_leds or 0)
+    d["puissance_actuelle_w"] += signe * (nb_eclairage or 0) * (puissance_w or 0)
+
+def contribution_client(deltas, client, signe=1):
+    ajouter_contribution_kpi(deltas, client.statut, client.nb_eclairage, client.nb_leds_preconise, client.puissance_w, signe)
+
+def appliquer_deltas_kpi(deltas):
+    """Applique les deltas dans la transaction en cours (UPDATE col = col + delta, sans relire la table clients)."""
+    table = KpiStatutModel.__table__
+    for statut, d in deltas.items():
+        if not any(d.values()): continue
+        maj = session.execute(table.update().where(table.c.statut == statut).values({c: table.c[c] + d[c] for c in COLONNES_KPI}))
+        if maj.rowcount == 0:
+            session.execute(table.insert().values(statut=statut, **d))
+
+def calculer_kpi():
+    # Recalcul complet (GROUP BY sur clients) : sert à la reconstruction et au contrôle
+    produit = func.coalesce(ClientModel.nb_eclairage, 0) * func.coalesce(ClientModel.puissance_w, 0)
+    lignes = session.query(
+        ClientModel.statut, func.count(ClientModel.id), func.coalesce(func.sum(ClientModel.nb_eclairage), 0),
+        func.coalesce(func.sum(ClientModel.nb_leds_preconise), 0), func.coalesce(func.sum(produit), 0)
+    ).group_by(ClientModel.statut)
+    kpi = {statut: dict.fromkeys(COLONNES_KPI, 0) for statut in STATUTS}
+    for statut, *valeurs in lignes:
+        d = kpi.setdefault(statut or "Nouveau", dict.fromkeys(COLONNES_KPI, 0))
+        for colonne, valeur in zip(COLONNES_KPI, valeurs): d[colonne] += valeur
+    return kpi
+
+def lire_kpi():
+    return {k.statut: {c: getattr(k, c) for c in COLONNES_KPI} for k in session.query(KpiStatutModel)}
+
+def reconstruire_kpi():
+    session.query(KpiStatutModel).delete()
+    session.add_all([KpiStatutModel(statut=statut, **valeurs) for statut, valeurs in calculer_kpi().items()])
+    session.commit()
+    marquer_modification()
+
+def verifier_kpi():
+    """Compare la table de synthèse au recalcul complet, renvoie [(statut, colonne, stocké, attendu)]."""
+    stockes, attendus = lire_kpi(), calculer_kpi()
+    ecarts = []
+    for statut in sorted(set(stockes) | set(attendus)):
+        for colonne in COLONNES_KPI:
+            stocke = (stockes.get(statut) or {}).get(colonne, 0)
+            attendu = (attendus.get(statut) or {}).get(colonne, 0)
+            if abs(stocke - attendu) > 1e-6: ecarts.append((statut, colonne, stocke, attendu))
+    return ecarts
+
+# --- STOCKAGE ---
+# Interface commune : upload(path, data, content_type), url_publique(path), supprimer(paths),
+# lister() -> (path, date de modification UTC) pour chaque objet du bucket
+def _date_utc(valeur):
+    if not valeur: return None
+    return datetime.fromisoformat(valeur.replace("Z", "+00:00")).astimezone(timezone.utc).replace(tzinfo=None)
+
+class StockageSupabase:
+    def __init__(self, client, bucket):
+        self.client = client
+        self.bucket = bucket
+
+    def upload(self, path, data, content_type):
+        self.client.storage.from_(self.bucket).upload(path=path, file=data, file_options={"content-type": content_type or "application/octet-stream", "x-upsert": "true"})
+
+    def url_publique(self, path):
+        return self.client.storage.from_(self.bucket).get_public_url(path)
+
+    def supprimer(self, paths):
+        self.client.storage.from_(self.bucket).remove(paths)
+
+    def lister(self, prefixe=""):
+        bucket, offset = self.client.storage.from_(self.bucket), 0
+        while True:
+            entrees = bucket.list(prefixe, {"limit": 1000, "offset": offset, "sortBy": {"column": "name", "order": "asc"}})
+            for entree in entrees:
+                path = f"{prefixe}/{entree['name']}" if prefixe else entree["name"]
+                if entree.get("id") is None: yield from self.lister(path)  # Dossier
+                else: yield path, _date_utc(entree.get("updated_at") or entree.get("created_at"))
+            if len(entrees) < 1000: return
+            offset += 1000
+
+class StockageLocal:
+    """Bucket sur disque local (développement, benchmarks hors-ligne)."""
+    def __init__(self, racine, url_base=None):
+        self.racine = os.path.abspath(racine)
+        self.url_base = url_base.rstrip("/") if url_base else None
+
+    def _chemin(self, path):
+        return os.path.join(self.racine, *path.split("/"))
+
+    def upload(self, path, data, content_type):
+        chemin = self._chemin(path)
+        os.makedirs(os.path.dirname(chemin), exist_ok=True)
+        with open(chemin, "wb") as f: f.write(data)
+
+    def url_publique(self, path):
+        if self.url_base: return f"{self.url_base}/{path}"
+        return "file://" + self._chemin(path)
+
+    def supprimer(self, paths):
+        for path in paths:
+            try: os.remove(self._chemin(path))
+            except FileNotFoundError: pass
+
+    def lister(self):
+        for dossier, _, fichiers in os.walk(self.racine):
+            for nom in fichiers:
+                chemin = os.path.join(dossier, nom)
+                path = os.path.relpath(chemin, self.racine).replace(os.sep, "/")
+                yield path, datetime.fromtimestamp(os.path.getmtime(chemin), timezone.utc).replace(tzinfo=None)
+
+@st.cache_resource
+def get_stockage():
+    if _conf("storage", "backend", "supabase") == "local":
+        stockage = StockageLocal(_conf("storage", "local_dir", "storage_local"), _conf("storage", "local_url", None))
+    else:
+        from supabase import create_client  # Import coûteux : seulement si le stockage Supabase est utilisé
+        stockage = StockageSupabase(create_client(SUPABASE_URL, SUPABASE_KEY), BUCKET_NAME)
+    return StockageMesure(stockage) if PERF_ACTIF else stockage
 
 # --- FONCTIONS ---
-def fetch_siret_data(siret):
-    siret_clean = siret.replace(" ", "")
-    url = f"https://recherche-entreprises.api.gouv.fr/search?q={siret_clean}"
+class CacheTTL:
+    """Cache LRU en mémoire avec expiration par entrée."""
+    def __init__(self, taille_max):
+        self.taille_max = taille_max
+        self._entrees = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lire(self, cle):
+        # Renvoie (présent, valeur)
+        with self._lock:
+            entree = self._entrees.get(cle)
+            if entree is None: return False, None
+            expire, valeur = entree
+            if expire < time.monotonic():
+                del self._entrees[cle]
+                return False, None
+            self._entrees.move_to_end(cle)
+            return True, valeur
+
+    def ecrire(self, cle, valeur, ttl):
+        with self._lock:
+            self._entrees[cle] = (time.monotonic() + ttl.total_seconds(), valeur)
+            self._entrees.move_to_end(cle)
+            while len(self._entrees) > self.taille_max:
+                self._entrees.popitem(last=False)
+
+class LimiteurDebit:
+    """Espace les appels d'au moins 1/debit secondes, tous threads confondus."""
+    def __init__(self, debit):
+        self.intervalle = 1.0 / debit
+        self._prochain = 0.0
+        self._lock = threading.Lock()
+
+    def attendre(self):
+        with self._lock:
+            maintenant = time.monotonic()
+            depart = max(maintenant, self._prochain)
+            self._prochain = depart + self.intervalle
+        if depart > maintenant: time.sleep(depart - maintenant)
+
+@st.cache_resource
+def get_cache_siret():
+    return CacheTTL(2048)
+
+@st.cache_resource
+def get_limiteur_siret():
+    return LimiteurDebit(SIRET_DEBIT_MAX)
+
+def _maintenant():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+def nettoyer_siret(siret):
+    return re.sub(r'\D', '', siret or "")
+
+def _interroger_api_siret(siret_clean, http):
+    """Appel réseau seul : renvoie les infos, None si SIRET inconnu, lève une exception si l'API échoue."""
+    get_limiteur_siret().attendre()
+    with chrono("siret.api"): response = http.get(SIRET_API_URL, params={"q": siret_clean}, timeout=10)
+    response.raise_for_status()
+    results = response.json().get('results')
+    if not results: return None
+    data = results[0]
+    return {
+        "nom_complet": data.get('nom_complet'),
+        "adresse": (data.get('siege') or {}).get('adresse'),
+        "siret_clean": siret_clean
+    }
+
+def _lire_caches_siret(sirets):
+    """Cherche en mémoire puis en base. Renvoie ({siret: infos ou None}, sirets à interroger)."""
+    cache, trouves, restants = get_cache_siret(), {}, []
+    for siret in sirets:
+        present, valeur = cache.lire(siret)
+        if present: trouves[siret] = valeur
+        else: restants.append(siret)
+    if restants:
+        maintenant = _maintenant()
+        for ligne in session.query(EntrepriseCacheModel).filter(EntrepriseCacheModel.siret.in_(restants)):
+            ttl = SIRET_TTL if ligne.trouve else SIRET_TTL_NEGATIF
+            if ligne.maj_le and ligne.maj_le + ttl > maintenant:
+                infos = {"nom_complet": ligne.nom_complet, "adresse": ligne.adresse, "siret_clean": ligne.siret} if ligne.trouve else None
+                trouves[ligne.siret] = infos
+                cache.ecrire(ligne.siret, infos, ttl - (maintenant - ligne.maj_le))
+        restants = [s for s in restants if s not in trouves]
+    return trouves, restants
+
+def _ecrire_caches_siret(resultats):
+    """Upsert groupé (INSERT ... ON CONFLICT DO UPDATE) : deux sessions qui résolvent le même SIRET
+    en même temps ne se gênent pas. Une écriture de cache en échec ne fait jamais échouer la recherche."""
+    maintenant, lignes = _maintenant(), []
+    for siret, infos in resultats.items():
+        get_cache_siret().ecrire(siret, infos, SIRET_TTL if infos else SIRET_TTL_NEGATIF)
+        lignes.append({"siret": siret, "nom_complet": infos["nom_complet"] if infos else None,
+                       "adresse": infos["adresse"] if infos else None, "trouve": bool(infos), "maj_le": maintenant})
+    table = EntrepriseCacheModel.__table__
+    upsert = (insert_postgresql if session.get_bind().dialect.name == "postgresql" else insert_sqlite)(table)
+    upsert = upsert.on_conflict_do_update(index_elements=[table.c.siret],
+                                          set_={c: upsert.excluded[c] for c in ("nom_complet", "adresse", "trouve", "maj_le")})
     try:
-        response = requests.get(url)
-        if response.status_code == 200 and response.json().get('results'):
-            data = response.json()['results'][0]
-            return {
-                "nom_complet": data.get('nom_complet'),
-                "adresse": data.get('siege', {}).get('adresse'),
-                "siret_clean": siret_clean
-            }
-    except: return None
-    return None
+        session.execute(upsert, lignes)
+        session.commit()
+    except SQLAlchemyError:
+        session.rollback()
+        journal.warning("Cache SIRET : écriture impossible", exc_info=True)
+
+def fetch_siret_data(siret, http=None):
+    # Pas de chrono englobant : l'appel API est mesuré (siret.api), les lectures de cache le sont en sql
+    siret_clean = nettoyer_siret(siret)
+    if not siret_clean: return None
+    trouves, restants = _lire_caches_siret([siret_clean])
+    if not restants: return trouves[siret_clean]
+    try: infos = _interroger_api_siret(siret_clean, http or get_http())
+    except Exception: return None  # Erreur réseau/API : rien en cache, on retentera
+    _ecrire_caches_siret({siret_clean: infos})
+    return infos
+
+def resoudre_sirets(sirets, http=None):
+    """Résolution par lot : caches d'abord, puis API en parallèle (débit limité).
+
+    Renvoie {siret nettoyé: infos ou None}. Les SIRET en erreur réseau sont absents du résultat.
+    """
+    sirets = list(dict.fromkeys(s for s in map(nettoyer_siret, sirets) if s))
+    resultats, restants = _lire_caches_siret(sirets)
+    http = http or get_http()
+    nouveaux = {}
+    with ThreadPoolExecutor(max_workers=SIRET_WORKERS) as pool:
+        taches = {siret: pool.submit(propager_mesures(_interroger_api_siret), siret, http) for siret in restants}
+        for siret, tache in taches.items():
+            try: nouveaux[siret] = tache.result()
+            except Exception: pass
+    if nouveaux: _ecrire_caches_siret(nouveaux)
+    resultats.update(nouveaux)
+    return resultats
 
 def clean_filename(text):
     text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode('utf-8')
     return text.replace(" ", "_").replace("/", "-")
 
-def ajouter_client(data, uploads_dict):
-    caract_remplies = {k: v for k, v in data['caracteristiques'].items() if v}
-    caract_json = json.dumps(caract_remplies) if caract_remplies else None
+def ajouter_client(data, uploads_dict=None):
     nouveau = ClientModel(
         nom=data['nom'], prenom=data['prenom'], entreprise=data['entreprise'],
         siret=data['siret'], adresse_kbis=data['adresse_kbis'], adresse_travaux=data['adresse_travaux'],
-        email=data['email'], telephone=data['telephone'], nb_eclairage=str(data['nb_eclairage']),
-        nb_leds_preconise=str(data['nb_leds_preconise']), statut="Nouveau", note=data['note'],
-        caracteristiques_json=caract_json
+        email=data['email'], telephone=data['telephone'], nb_eclairage=data['nb_eclairage'],
+        nb_leds_preconise=data['nb_leds_preconise'], statut="Nouveau", note=data['note'],
+        superficie_m2=data['superficie_m2'], hauteur_m=data['hauteur_m'],
+        type_eclairage=data['type_eclairage'], puissance_w=data['puissance_w']
     )
     session.add(nouveau)
+    deltas = {}
+    contribution_client(deltas, nouveau)
+    appliquer_deltas_kpi(deltas)
     session.commit()
-    
-    for cat, files in uploads_dict.items():
-        if files:
-            sauvegarder_fichiers(nouveau.id, files, cat)
-
-def sauvegarder_fichiers(client_id, liste_fichiers, categorie):
-    cat_clean = clean_filename(categorie)
-    for fichier in liste_fichiers:
-        nom_fic_clean = clean_filename(fichier.name)
-        file_path = f"{client_id}/{cat_clean}_{nom_fic_clean}"
+    marquer_modification()
+    if uploads_dict: sauvegarder_categories(nouveau.id, uploads_dict)
+    return nouveau.id
+
+def sauvegarder_categories(client_id, uploads_dict, progression=None):
+    """Envoie {catégorie: fichiers} l'une après l'autre, renvoie le rapport cumulé."""
+    resultat = {"ok": [], "echecs": []}
+    a_envoyer = [(cat, files) for cat, files in uploads_dict.items() if files]
+    for i, (cat, files) in enumerate(a_envoyer):
+        res_cat = sauvegarder_fichiers(client_id, files, cat)
+        resultat["ok"] += res_cat["ok"]
+        resultat["echecs"] += res_cat["echecs"]
+        if progression: progression((i + 1) / len(a_envoyer), cat)
+    return resultat
+
+def _upload_avec_reprise(stockage, path, data, content_type):
+    # Nouvel essai avec backoff exponentiel (0.5s, 1s, 2s...) sur erreur réseau/stockage
+    for tentative in range(UPLOAD_TENTATIVES):
+        try:
+            stockage.upload(path, data, content_type)
+            return stockage.url_publique(path)
+        except Exception:
+            if tentative == UPLOAD_TENTATIVES - 1: raise
+            time.sleep(0.5 * 2 ** tentative)
+
+@st.cache_resource
+def get_pool_images():
+    # Process séparés : le décodage/encodage Pillow ne bloque pas le thread du script
+    return ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+
+def _soumettre_normalisation(data):
+    try: return get_pool_images().submit(normaliser_image, data, IMAGE_TAILLE_MAX, IMAGE_QUALITE, IMAGE_MINIATURE)
+    except Exception:
+        get_pool_images.clear()  # Pool cassé (process fils tué) : recréé au prochain envoi
+        return None
+
+def empreinte_contenu(fichier, taille_bloc=1024 * 1024):
+    """SHA-256 du contenu, lu par blocs ; le fichier est rembobiné au début."""
+    h = hashlib.sha256()
+    fichier.seek(0)
+    for bloc in iter(lambda: fichier.read(taille_bloc), b""):
+        h.update(bloc)
+    fichier.seek(0)
+    return h.hexdigest()
+
+def _objets_par_hash(hashes):
+    # Objets déjà présents dans le bucket pour ces contenus : {hash: colonnes de stockage}
+    objets = {}
+    for h, *valeurs in session.query(FichierClientModel.hash_contenu, FichierClientModel.path_storage, FichierClientModel.url_public,
+                                     FichierClientModel.path_miniature, FichierClientModel.url_miniature).filter(FichierClientModel.hash_contenu.in_(hashes)):
+        objets.setdefault(h, dict(zip(("path_storage", "url_public", "path_miniature", "url_miniature"), valeurs)))
+    return objets
+
+def _envoyer_fichier(stockage, envoi):
+    """Normalise (si image) puis envoie un fichier et sa miniature, renvoie les colonnes du FichierClientModel."""
+    path, data, content_type = envoi["path"], envoi["data"], envoi["content_type"]
+    ligne = {"path_miniature": None, "url_miniature": None}
+    if envoi["normalisation"] is not None:
         try:
-            fichier.seek(0)
-            file_bytes = fichier.read()
-            supabase.storage.from_(BUCKET_NAME).upload(path=file_path, file=file_bytes, file_options={"content-type": fichier.type, "x-upsert": "true"})
-            public_url = supabase.storage.from_(BUCKET_NAME).get_public_url(file_path)
-            session.add(FichierClientModel(
-                client_id=client_id, nom_fichier=fichier.name, categorie=categorie,
-                path_storage=file_path, url_public=public_url
-            ))
-        except Exception as e: st.error(f"Erreur upload {fichier.name}: {str(e)}")
+            data, miniature = envoi["normalisation"].result()
+            path, content_type = os.path.splitext(path)[0] + ".jpg", "image/jpeg"
+            ligne["path_miniature"] = envoi["path_miniature"]
+            ligne["url_miniature"] = _upload_avec_reprise(stockage, envoi["path_miniature"], miniature, "image/jpeg")
+        except Exception: pass  # Image illisible par Pillow : envoi de l'original, sans miniature
+    ligne["path_storage"] = path
+    ligne["url_public"] = _upload_avec_reprise(stockage, path, data, content_type)
+    return ligne
+
+def sauvegarder_fichiers(client_id, liste_fichiers, categorie, stockage=None, progression=None):
+    """Envoie les fichiers en parallèle puis insère toutes les lignes en un seul INSERT.
+
+    Stockage adressé par contenu : objets/{sha[:2]}/{sha}.ext. Un contenu déjà présent
+    (même fichier renvoyé, ou en double dans le lot) n'est pas renvoyé : seule la ligne
+    est écrite. Les images sont normalisées (orientation, taille max, JPEG) dans le pool
+    de process avant l'envoi, avec une miniature objets/{sha[:2]}/{sha}_min.jpg.
+    Renvoie {"ok": [noms], "echecs": [(nom, erreur)], "dedupliques": nb de fichiers non renvoyés}.
+    """
+    stockage = stockage or get_stockage()
+    fichiers = [(fichier, empreinte_contenu(fichier)) for fichier in liste_fichiers]
+    if not fichiers: return {"ok": [], "echecs": [], "dedupliques": 0}
+    objets = _objets_par_hash({h for _, h in fichiers})
+    envois = {}  # Un seul envoi par contenu
+    for fichier, h in fichiers:
+        if h in objets or h in envois: continue
+        data = fichier.read()
+        base = f"objets/{h[:2]}/{h}"
+        envois[h] = {
+            "content_type": fichier.type, "data": data,
+            "path": base + clean_filename(os.path.splitext(fichier.name)[1].lower()),
+            "path_miniature": f"{base}_min.jpg",
+            "normalisation": _soumettre_normalisation(data) if est_image(fichier.name) else None
+        }
+
+    erreurs = {}
+    if envois:
+        _reprendre_suppressions(envois.values())
+        with ThreadPoolExecutor(max_workers=min(UPLOAD_WORKERS, len(envois))) as pool:
+            envoyer = propager_mesures(_envoyer_fichier)
+            taches = {h: pool.submit(envoyer, stockage, envoi) for h, envoi in envois.items()}
+            for i, (h, tache) in enumerate(taches.items()):
+                try: objets[h] = tache.result()
+                except Exception as e: erreurs[h] = str(e)
+                if progression: progression((i + 1) / len(taches))
+
+    resultat, lignes = {"ok": [], "echecs": [], "dedupliques": len(fichiers) - len(envois)}, []
+    for fichier, h in fichiers:
+        if h in objets:
+            lignes.append({"client_id": client_id, "nom_fichier": fichier.name, "categorie": categorie, "hash_contenu": h, **objets[h]})
+            resultat["ok"].append(fichier.name)
+        else: resultat["echecs"].append((fichier.name, erreurs[h]))
+
+    if lignes:
+        paths = _paths_stockage([SimpleNamespace(**l) for l in lignes])
+        # Objet de nouveau référencé : retiré de la file de suppression
+        session.query(SuppressionEnAttenteModel).filter(SuppressionEnAttenteModel.path.in_(paths)).delete(synchronize_session=False)
+        session.execute(insert(FichierClientModel), lignes)
+        session.commit()
+        marquer_modification()
+        invalider_dossier(client_id)
+    return resultat
+
+def _reprendre_suppressions(envois):
+    """Retire de la file de suppression les objets sur le point d'être réécrits, avant l'envoi.
+
+    Le DELETE attend une purge qui tiendrait ces lignes (FOR UPDATE) : elle finit de supprimer
+    l'objet, puis l'envoi le réécrit. Sans cela la purge pourrait effacer l'objet tout juste renvoyé.
+    """
+    paths = {p for e in envois for p in (e["path"], os.path.splitext(e["path"])[0] + ".jpg", e["path_miniature"])}
+    # Contrôle sans verrou d'abord : le cas courant (rien en attente) ne prend pas de verrou d'écriture
+    if session.query(SuppressionEnAttenteModel.path).filter(SuppressionEnAttenteModel.path.in_(paths)).first():
+        session.query(SuppressionEnAttenteModel).filter(SuppressionEnAttenteModel.path.in_(paths)).delete(synchronize_session=False)
+
+def afficher_rapport_upload():
+    # Rapport du dernier envoi (conservé en session pour survivre au st.rerun)
+    resultat = st.session_state.pop('rapport_upload', None)
+    if not resultat: return
+    if resultat["ok"]: st.success(f"{len(resultat['ok'])} fichier(s) envoyé(s).")
+    if resultat.get("dedupliques"): st.caption(f"{resultat['dedupliques']} fichier(s) déjà présent(s) dans le stockage : non renvoyé(s).")
+    if resultat["echecs"]:
+        st.error(f"{len(resultat['echecs'])} fichier(s) en échec :\n" + "\n".join(f"- {nom} : {err}" for nom, err in resultat["echecs"]))
+
+def _paths_stockage(fichiers):
+    # Objets du bucket associés aux fichiers : original + miniature éventuelle
+    return [p for f in fichiers for p in (f.path_storage, f.path_miniature) if p]
+
+def _paths_references(paths):
+    # Paths encore utilisés par une ligne de fichiers_clients (original ou miniature)
+    references = set()
+    paths = list(paths)
+    for i in range(0, len(paths), PURGE_LOT):
+        lot = paths[i:i + PURGE_LOT]
+        for p_storage, p_miniature in session.query(FichierClientModel.path_storage, FichierClientModel.path_miniature).filter(
+                FichierClientModel.path_storage.in_(lot) | FichierClientModel.path_miniature.in_(lot)):
+            references.update((p_storage, p_miniature))
+    return references
+
+def planifier_suppressions(paths):
+    """Ajoute les objets à supprimer du bucket à la transaction en cours (supprimés par purger_suppressions)."""
+    paths = set(paths)
+    if not paths: return
+    deja = {p for (p,) in session.query(SuppressionEnAttenteModel.path).filter(SuppressionEnAttenteModel.path.in_(paths))}
+    session.add_all([SuppressionEnAttenteModel(path=p, tentatives=0, prochaine_tentative=_maintenant()) for p in paths - deja])
+
+def purger_suppressions(stockage=None, progression=None):
+    """Supprime du bucket les objets en attente, par lots ; un lot en échec est repris plus tard (backoff).
+
+    Un path de nouveau référencé (fichier renvoyé sous le même nom) est retiré de la file sans être supprimé.
+    Les lignes du lot restent verrouillées (FOR UPDATE SKIP LOCKED, Postgres) du contrôle des références
+    jusqu'au commit qui suit la suppression dans le bucket : un envoi du même contenu attend la fin du lot
+    (voir _reprendre_suppressions), et deux purges concurrentes ne traitent pas les mêmes lignes.
+    """
+    resultat = {"supprimes": 0, "echecs": 0}
+    a_traiter = session.query(func.count(SuppressionEnAttenteModel.path)).filter(SuppressionEnAttenteModel.prochaine_tentative <= _maintenant()).scalar()
+    if not a_traiter: return resultat
+    stockage, traites = stockage or get_stockage(), 0
+    while traites < a_traiter:
+        maintenant = _maintenant()
+        dues = (session.query(SuppressionEnAttenteModel).filter(SuppressionEnAttenteModel.prochaine_tentative <= maintenant)
+                .order_by(SuppressionEnAttenteModel.prochaine_tentative).limit(PURGE_LOT).with_for_update(skip_locked=True).all())
+        if not dues: break
+        references = _paths_references(d.path for d in dues)
+        a_supprimer = [d.path for d in dues if d.path not in references]
+        try:
+            if a_supprimer: stockage.supprimer(a_supprimer)
+            for d in dues: session.delete(d)
+            resultat["supprimes"] += len(a_supprimer)
+        except Exception as e:
+            for d in dues:
+                d.tentatives += 1
+                d.derniere_erreur = str(e)[:1000]
+                d.prochaine_tentative = maintenant + min(timedelta(seconds=PURGE_INTERVALLE) * 2 ** (d.tentatives - 1), timedelta(days=1))
+            resultat["echecs"] += len(dues)
+        session.commit()
+        traites += len(dues)
+        if progression: progression(min(traites / a_traiter, 1), f"{resultat['supprimes']} objet(s) supprimé(s)")
+    return resultat
+
+def reconcilier_stockage(stockage=None, progression=None):
+    """Planifie la suppression des objets du bucket qu'aucune ligne de fichiers_clients ne référence.
+
+    Les objets modifiés depuis moins de RECONCILIATION_GRACE sont ignorés : un envoi
+    en cours écrit dans le bucket avant d'insérer sa ligne en base.
+    """
+    stockage = stockage or get_stockage()
+    limite = _maintenant() - RECONCILIATION_GRACE
+    objets = list(stockage.lister())
+    candidats = [path for path, modifie_le in objets if modifie_le and modifie_le < limite]
+    if progression: progression(0.5, f"{len(objets)} objet(s) listé(s)")
+    references = _paths_references(candidats)
+    orphelins = [p for p in candidats if p not in references]
+    planifier_suppressions(orphelins)
     session.commit()
+    resultat = {"objets": len(objets), "orphelins": len(orphelins)}
+    if orphelins: resultat.update(purger_suppressions(stockage))
+    return resultat
+
+def _liberer_objets(paths):
+    # Comptage de références : un objet partagé (même contenu) reste tant qu'une ligne le référence
+    session.flush()
+    paths = set(paths)
+    planifier_suppressions(paths - _paths_references(paths))
 
 def supprimer_un_fichier(fichier_id):
     fichier = session.query(FichierClientModel).get(fichier_id)
     if fichier:
-        try: supabase.storage.from_(BUCKET_NAME).remove([fichier.path_storage])
-        except: pass
         session.delete(fichier)
+        _liberer_objets(_paths_stockage([fichier]))
         session.commit()
+        marquer_modification()
+        invalider_dossier(fichier.client_id, [fichier])
 
 def supprimer_categorie_entiere(client_id, categorie):
     fichiers = session.query(FichierClientModel).filter_by(client_id=client_id, categorie=categorie).all()
     if fichiers:
-        paths = [f.path_storage for f in fichiers]
-        try: supabase.storage.from_(BUCKET_NAME).remove(paths)
-        except: pass
         for f in fichiers:
             session.delete(f)
+        _liberer_objets(_paths_stockage(fichiers))
         session.commit()
+        marquer_modification()
+        invalider_dossier(client_id, fichiers)
 
 def supprimer_client_entier(client_id):
-    client = session.query(ClientModel).get(client_id)
+    """Supprime le client et ses fichiers en base ; les objets du bucket passent par la file de suppression."""
+    client = _client_verrouille(client_id)
     if client:
-        try: 
-            paths = [f.path_storage for f in client.fichiers]
-            if paths: supabase.storage.from_(BUCKET_NAME).remove(paths)
-        except: pass
+        paths = _paths_stockage(client.fichiers)
+        deltas = {}
+        contribution_client(deltas, client, -1)
+        appliquer_deltas_kpi(deltas)
+        session.query(HistoriqueStatutModel).filter_by(client_id=client_id).delete(synchronize_session=False)
         session.delete(client)
+        _liberer_objets(paths)
         session.commit()
+        marquer_modification()
+        invalider_dossier(client_id)
+
+@st.cache_resource
+def get_http():
+    # Session HTTP partagée : connexions keep-alive réutilisées entre téléchargements
+    http = requests.Session()
+    adaptateur = HTTPAdapter(pool_connections=4, pool_maxsize=max(PDF_WORKERS, SIRET_WORKERS) * 2)
+    http.mount("https://", adaptateur)
+    http.mount("http://", adaptateur)
+    return http
+
+def _telecharger(url):
+    # Fichier en mémoire jusqu'à sa part de PDF_SPOOL_TOTAL (au plus PDF_SPOOL_MAX), au-delà basculé sur disque.
+    # Au plus PDF_WORKERS + 1 fichiers ouverts à la fois (voir _sources_dans_l_ordre)
+    tmp = tempfile.SpooledTemporaryFile(max_size=min(PDF_SPOOL_MAX, PDF_SPOOL_TOTAL // (PDF_WORKERS + 1)))
+    try:
+        with chrono("pdf.telechargement"), get_http().get(url, stream=True, timeout=60) as r:
+            r.raise_for_status()
+            for bloc in r.iter_content(chunk_size=256 * 1024):
+                tmp.write(bloc)
+    except Exception:
+        tmp.close()
+        return None
+    tmp.seek(0)
+    return tmp
 
-def generer_pdf_fusionne(client_id):
+# Cache disque : dossiers/{client_id}_{empreinte}.pdf et pages/{hash du contenu}.pdf
+def _chemin_dossier(client_id, empreinte):
+    return os.path.join(PDF_DOSSIER, "dossiers", f"{client_id}_{empreinte}.pdf")
+
+def _chemin_page(fichier):
+    # Page partagée entre clients pour un même contenu ; fichiers antérieurs au hash : clé = hash du path
+    cle = fichier.hash_contenu or hashlib.sha256(fichier.path_storage.encode()).hexdigest()
+    return os.path.join(PDF_DOSSIER, "pages", cle + ".pdf")
+
+def empreinte_dossier(fichiers):
+    h = hashlib.sha256()
+    for f in fichiers:
+        h.update(f"{f.path_storage}\x00{f.categorie}\x00".encode())
+    return h.hexdigest()[:32]
+
+def invalider_dossier(client_id, fichiers=()):
+    # Appelé à chaque modification des fichiers du client. Les pages adressées par contenu
+    # ne deviennent jamais fausses : seules celles des anciens fichiers (path réécrit) sont retirées.
+    for chemin in glob.glob(os.path.join(PDF_DOSSIER, "dossiers", f"{client_id}_*.pdf")):
+        try: os.remove(chemin)
+        except FileNotFoundError: pass
+    for fichier in fichiers:
+        if fichier.hash_contenu: continue
+        try: os.remove(_chemin_page(fichier))
+        except FileNotFoundError: pass
+
+def _evincer_cache_pdf():
+    # Suppression des entrées les moins récemment utilisées au-delà de PDF_CACHE_MAX
+    entrees = []
+    for chemin in glob.glob(os.path.join(PDF_DOSSIER, "*", "*.pdf")):
+        try: entrees.append((os.path.getmtime(chemin), os.path.getsize(chemin), chemin))
+        except FileNotFoundError: pass
+    total = sum(taille for _, taille, _ in entrees)
+    for _, taille, chemin in sorted(entrees):
+        if total <= PDF_CACHE_MAX: break
+        try: os.remove(chemin)
+        except FileNotFoundError: pass
+        total -= taille
+
+def _ecrire_atomique(chemin, ecrire):
+    os.makedirs(os.path.dirname(chemin), exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(chemin), suffix=".tmp", delete=False) as sortie:
+        ecrire(sortie)
+    os.replace(sortie.name, chemin)
+
+def _source_pdf(db_file):
+    """Renvoie le fichier PDF ouvert correspondant à db_file (page image convertie et mise en cache)."""
+    # Les images ont été normalisées à l'upload (JPEG à taille de page) : conversion directe
+    if db_file.nom_fichier.lower().endswith('.pdf'):
+        return _telecharger(db_file.url_public)
+    chemin_page = _chemin_page(db_file)
+    if not os.path.exists(chemin_page):
+        from PIL import Image
+        contenu = _telecharger(db_file.url_public)
+        if contenu is None: return None
+        try:
+            with chrono("pdf.conversion"), contenu, Image.open(contenu) as image:
+                if image.mode in ('RGBA', 'P'): image = image.convert('RGB')
+                _ecrire_atomique(chemin_page, lambda sortie: image.save(sortie, format='PDF'))
+        except Exception: return None
+    try: os.utime(chemin_page)
+    except FileNotFoundError: return None
+    return open(chemin_page, "rb")
+
+def _sources_dans_l_ordre(fichiers):
+    """Renvoie les sources PDF dans l'ordre, avec au plus PDF_WORKERS téléchargements d'avance."""
+    with ThreadPoolExecutor(max_workers=PDF_WORKERS) as pool:
+        source, restants, en_cours = propager_mesures(_source_pdf), iter(fichiers), deque()
+        try:
+            for fichier in restants:
+                en_cours.append(pool.submit(source, fichier))
+                if len(en_cours) == PDF_WORKERS: break
+            while en_cours:
+                contenu = en_cours.popleft().result()
+                suivant = next(restants, None)
+                if suivant is not None: en_cours.append(pool.submit(source, suivant))
+                yield contenu
+        finally:
+            # Fusion interrompue : fermeture des fichiers déjà téléchargés
+            for tache in en_cours:
+                contenu = tache.result()
+                if contenu is not None: contenu.close()
+
+def generer_pdf_fusionne(client_id, progression=None):
+    """Fusionne les fichiers du client dans l'ordre des catégories, renvoie le chemin du PDF.
+
+    Le dossier est servi depuis le cache disque tant que l'empreinte des fichiers ne change pas.
+    Chaque source est fermée dès qu'elle est fusionnée (pypdf en copie les objets) : seules
+    les pages fusionnées restent en mémoire jusqu'à l'écriture.
+    """
     client = session.query(ClientModel).get(client_id)
     if not client: return None
 
-    files_to_merge = []
-    ordre_logique = ["Devis Signé", "Captures Géoportail", "Photos Local", "Pièces Supplémentaires"]
-    
-    for cat in ordre_logique:
-        fichiers_cat = [f for f in client.fichiers if f.categorie == cat]
-        for db_file in fichiers_cat:
-            try:
-                r = requests.get(db_file.url_public)
-                if r.status_code == 200:
-                    files_to_merge.append((db_file.nom_fichier, io.BytesIO(r.content)))
-            except: pass
+    a_fusionner = [f for cat in CATEGORIES for f in sorted(client.fichiers, key=lambda f: f.id) if f.categorie == cat]
+    a_fusionner = [f for f in a_fusionner if f.nom_fichier.lower().endswith('.pdf') or est_image(f.nom_fichier)]
+    if not a_fusionner: return None
 
-    if not files_to_merge: return None
+    chemin = _chemin_dossier(client_id, empreinte_dossier(a_fusionner))
+    if os.path.exists(chemin):
+        os.utime(chemin)
+        return chemin
 
+    from pypdf import PdfWriter, PdfReader  # Chargé à la première fusion seulement
     merger = PdfWriter()
-    for name, file_bytes in files_to_merge:
-        is_pdf = name.lower().endswith('.pdf')
-        is_img = name.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
-        
-        if is_pdf:
-            try:
-                reader = PdfReader(file_bytes)
-                merger.append(reader)
-            except: pass
-        elif is_img:
+    try:
+        # Fusion au fil de l'eau pendant que la suite se télécharge
+        for i, contenu in enumerate(_sources_dans_l_ordre(a_fusionner)):
+            if progression: progression((i + 1) / len(a_fusionner), a_fusionner[i].nom_fichier)
+            if contenu is None: continue
             try:
-                image = Image.open(file_bytes)
-                if image.mode in ('RGBA', 'P'): image = image.convert('RGB')
-                pdf_bytes = io.BytesIO()
-                image.save(pdf_bytes, format='PDF')
-                pdf_bytes.seek(0)
-                merger.append(PdfReader(pdf_bytes))
-            except: pass
-
-    output = io.BytesIO()
-    merger.write(output)
-    merger.close()
-    return output.getvalue()
-
-def verifier_categories_completes(client_id):
-    client = session.query(ClientModel).get(client_id)
-    cats = {f.categorie for f in client.fichiers}
-    required = {"Devis Signé", "Captures Géoportail", "Photos Local"}
-    return required.issubset(cats)
-
-def get_dataframe(recherche=""):
-    query = session.query(ClientModel)
-    if recherche:
-        term = f"%{recherche}%"
-        query = query.filter((ClientModel.nom.ilike(term)) | (ClientModel.prenom.ilike(term)) | (ClientModel.entreprise.ilike(term)))
-    clients = query.all()
+                with chrono("pdf.fusion"), contenu: merger.append(PdfReader(contenu))
+            except Exception: pass
+
+        if not len(merger.pages): return None
+        invalider_dossier(client_id)
+        with chrono("pdf.ecriture"): _ecrire_atomique(chemin, merger.write)
+    finally:
+        merger.close()
+    _evincer_cache_pdf()
+    return chemin
+
+def _client_verrouille(client_id):
+    # SELECT ... FOR UPDATE (Postgres) : une écriture concurrente sur ce client attend notre commit,
+    # puis relit l'état à jour. Sans verrou, deux sessions retireraient la même contribution KPI.
+    return session.query(ClientModel).filter_by(id=client_id).with_for_update().populate_existing().one_or_none()
+
+def modifier_client(client_id, valeurs):
+    client = _client_verrouille(client_id)
+    if client:
+        deltas = {}
+        contribution_client(deltas, client, -1)
+        ancien_statut = client.statut
+        for champ, valeur in valeurs.items():
+            setattr(client, champ, valeur)
+        contribution_client(deltas, client)
+        if client.statut != ancien_statut:
+            session.add(HistoriqueStatutModel(client_id=client.id, ancien_statut=ancien_statut, nouveau_statut=client.statut, change_le=_maintenant()))
+        appliquer_deltas_kpi(deltas)
+        session.commit()
+        marquer_modification()
+
+def _instantane(obj):
+    # Copie détachée des colonnes : partageable entre sessions via le cache
+    return SimpleNamespace(**{col.key: getattr(obj, col.key) for col in obj.__table__.columns})
+
+def charger_fiche_client(client_id):
+    # Client et fichiers en deux requêtes (selectinload), fichiers regroupés par catégorie une seule fois
+    client = session.query(ClientModel).options(selectinload(ClientModel.fichiers)).filter_by(id=client_id).one_or_none()
+    if not client: return None
+    fiche = _instantane(client)
+    fiche.fichiers = [_instantane(f) for f in sorted(client.fichiers, key=lambda f: f.id)]
+    fiche.fichiers_par_categorie = {}
+    for f in fiche.fichiers:
+        fiche.fichiers_par_categorie.setdefault(f.categorie, []).append(f)
+    return fiche
+
+def chercher_clients(recherche="", page=1, taille_page=TAILLE_PAGE_SELECTEUR):
+    """Libellés {id: texte} du sélecteur de clients, sans charger les autres colonnes."""
+    query = session.query(ClientModel.id, ClientModel.nom, ClientModel.prenom, ClientModel.entreprise)
+    query, ordre = _appliquer_recherche(query, recherche)
+    rows = query.order_by(*ordre, ClientModel.id).offset((max(page, 1) - 1) * taille_page).limit(taille_page)
+    return {c.id: f"{c.nom} {c.prenom or ''} ({c.entreprise or 'Indiv'})" for c in rows}
+
+def compter_fichiers_par_categorie(client_id):
+    return dict(session.query(FichierClientModel.categorie, func.count(FichierClientModel.id))
+                .filter_by(client_id=client_id).group_by(FichierClientModel.categorie).all())
+
+def dossier_complet(comptes):
+    return all(comptes.get(cat) for cat in CATEGORIES_REQUISES)
+
+# Colonnes triables du tableau de bord
+COLONNES_TRI = {
+    "ID": ClientModel.id, "Superficie (m²)": ClientModel.superficie_m2, "Puissance (W)": ClientModel.puissance_w,
+    "Nb Éclairages": ClientModel.nb_eclairage, "Nb LEDs": ClientModel.nb_leds_preconise, "Statut": ClientModel.statut,
+}
+
+def _appliquer_filtres(query, filtres):
+    """filtres : tuple de paires (clé, valeur), hashable pour servir de clé de cache.
+
+    Clés : statuts (tuple), surface_min, surface_max, puissance_min, puissance_max.
+    """
+    filtres = dict(filtres)
+    if filtres.get("statuts"): query = query.filter(ClientModel.statut.in_(filtres["statuts"]))
+    if filtres.get("surface_min"): query = query.filter(ClientModel.superficie_m2 >= filtres["surface_min"])
+    if filtres.get("surface_max"): query = query.filter(ClientModel.superficie_m2 <= filtres["surface_max"])
+    if filtres.get("puissance_min"): query = query.filter(ClientModel.puissance_w >= filtres["puissance_min"])
+    if filtres.get("puissance_max"): query = query.filter(ClientModel.puissance_w <= filtres["puissance_max"])
+    return query
+
+def compter_clients(recherche="", filtres=()):
+    query, _ = _appliquer_recherche(session.query(func.count(ClientModel.id)), recherche)
+    return _appliquer_filtres(query, filtres).scalar()
+
+def get_dataframe(recherche="", page=1, taille_page=TAILLE_PAGE_DEFAUT, filtres=(), tri="ID", decroissant=False):
+    # Nb de fichiers par sous-requête corrélée : comptée (via ix_fichiers_clients_client_id) pour les seules lignes de la page
+    nb_fichiers = (select(func.count(FichierClientModel.id)).where(FichierClientModel.client_id == ClientModel.id)
+                   .correlate(ClientModel).scalar_subquery())
+    query = session.query(ClientModel, nb_fichiers)
+    query, ordre = _appliquer_recherche(query, recherche)
+    query = _appliquer_filtres(query, filtres)
+    if tri != "ID" or decroissant:
+        colonne = COLONNES_TRI[tri]
+        ordre = [colonne.desc().nulls_last() if decroissant else colonne.asc().nulls_last()]
+    rows = query.order_by(*ordre, ClientModel.id).offset((max(page, 1) - 1) * taille_page).limit(taille_page).all()
     data = []
-    for c in clients:
-        c_str = ""
-        if c.caracteristiques_json:
-            try: c_str = ", ".join([f"{k}: {v}" for k, v in json.loads(c.caracteristiques_json).items()])
-            except: pass
+    for c, nb in rows:
         data.append({
             "ID": c.id, "Statut": c.statut, "Entreprise": c.entreprise, "Nom": c.nom, "Prénom": c.prenom,
             "Nb Éclairages": c.nb_eclairage, "Nb LEDs": c.nb_leds_preconise,
+            "Superficie (m²)": c.superficie_m2, "Hauteur (m)": c.hauteur_m,
+            "Type Éclairage": c.type_eclairage, "Puissance (W)": c.puissance_w,
             "Adresse KBIS": c.adresse_kbis, "Adresse Travaux": c.adresse_travaux, "Email": c.email,
-            "Téléphone": c.telephone, "SIRET": c.siret, "Caractéristiques": c_str, "Note": c.note,
-            "Fichiers": f"{len(c.fichiers)} fichier(s)"
+            "Téléphone": c.telephone, "SIRET": c.siret, "Note": c.note,
+            "Fichiers": f"{nb} fichier(s)"
         })
     return pd.DataFrame(data)
 
-def update_from_editor():
-    changes = st.session_state.get('main_editor')
+def changer_statuts(changements):
+    """Applique {client_id: nouveau statut} en une seule transaction, renvoie le nombre de clients modifiés.
+
+    Coût constant quel que soit le nombre de lignes : un SELECT ... FOR UPDATE des anciens statuts
+    (les deltas KPI partent de valeurs qu'aucune autre session ne peut modifier avant notre commit),
+    un UPDATE ... CASE, un INSERT groupé dans l'historique et les deltas KPI.
+    """
+    if not changements: return 0
+    # Verrous pris dans l'ordre des id : deux lots concurrents ne peuvent pas s'interbloquer
+    anciens = [a for a in session.query(ClientModel.id, ClientModel.statut, ClientModel.nb_eclairage, ClientModel.nb_leds_preconise, ClientModel.puissance_w)
+               .filter(ClientModel.id.in_(changements)).order_by(ClientModel.id).with_for_update() if a.statut != changements[a.id]]
+    if not anciens: return 0
+    deltas, historique, maintenant = {}, [], _maintenant()
+    for a in anciens:
+        ajouter_contribution_kpi(deltas, a.statut, a.nb_eclairage, a.nb_leds_preconise, a.puissance_w, -1)
+        ajouter_contribution_kpi(deltas, changements[a.id], a.nb_eclairage, a.nb_leds_preconise, a.puissance_w)
+        historique.append({"client_id": a.id, "ancien_statut": a.statut, "nouveau_statut": changements[a.id], "change_le": maintenant})
+    table = ClientModel.__table__
+    ids = [a.id for a in anciens]
+    session.execute(table.update().where(table.c.id.in_(ids)).values(statut=case({i: changements[i] for i in ids}, value=table.c.id)))
+    session.execute(HistoriqueStatutModel.__table__.insert(), historique)
+    appliquer_deltas_kpi(deltas)
+    session.commit()
+    marquer_modification()
+    return len(anciens)
+
+def historique_statuts(client_id):
+    return [(h.change_le, h.ancien_statut, h.nouveau_statut) for h in session.query(HistoriqueStatutModel)
+            .filter_by(client_id=client_id).order_by(HistoriqueStatutModel.change_le.desc(), HistoriqueStatutModel.id.desc())]
+
+def update_from_editor(cle_editor, ids_page):
+    # ids_page : IDs des lignes affichées, capturés au rendu de la page (indépendant de df.iloc)
+    changes = st.session_state.get(cle_editor)
     if not changes or not changes.get('edited_rows'): return
-    df = st.session_state['df_view']
-    for row_idx, modifications in changes['edited_rows'].items():
-        c_id = df.iloc[int(row_idx)]['ID']
-        client = session.query(ClientModel).get(int(c_id))
-        if client and "Statut" in modifications:
-            client.statut = modifications["Statut"]
-            session.commit()
-    st.session_state['refresh'] = True
+    changer_statuts({int(ids_page[int(row_idx)]): modifications["Statut"]
+                     for row_idx, modifications in changes['edited_rows'].items() if "Statut" in modifications})
 
 def clear_form_logic():
     if st.session_state.get('reset_needed'):
@@ -248,239 +1482,598 @@ def auto_copy_address():
     if st.session_state.get("w_checkbox_same", False):
         st.session_state['w_travaux'] = st.session_state.get("w_kbis", "")
 
+# Règles partagées par le formulaire et l'import en masse
+REGEX_SEPARATEURS_TEL = r'[\s\-\.]'
+REGEX_TELEPHONE = r"^(0\d{9}|\+33\d{9})$"
+REGEX_EMAIL = r"[^@]+@[^@]+\.[^@]+"
+
 def is_valid_phone(phone_str):
     if not phone_str: return True
-    clean_p = re.sub(r'[\s\-\.]', '', phone_str)
-    return bool(re.match(r"^0\d{9}$", clean_p) or re.match(r"^\+33\d{9}$", clean_p))
+    clean_p = re.sub(REGEX_SEPARATEURS_TEL, '', phone_str)
+    return bool(re.match(REGEX_TELEPHONE, clean_p))
 
 def is_valid_email(email_str):
     if not email_str: return True
-    return bool(re.match(r"[^@]+@[^@]+\.[^@]+", email_str))
+    return bool(re.match(REGEX_EMAIL, email_str))
 
-# --- INTERFACE ---
-st.set_page_config(page_title="CRM V19 - Auto Clear", layout="wide")
-if 'reset_needed' not in st.session_state: st.session_state['reset_needed'] = False
-if 'uploader_key' not in st.session_state: st.session_state['uploader_key'] = 0
-clear_form_logic() 
-
-with st.sidebar:
-    st.header("Nouveau Client")
-    st.subheader("1. Contact")
-    c_nom, c_prenom = st.columns(2)
-    c_nom.text_input("Nom *", key="w_nom")
-    c_prenom.text_input("Prénom", key="w_prenom")
-    st.text_input("Mail", key="w_email")
-    st.text_input("Téléphone", key="w_tel")
-    st.text_area("Note (Interne)", key="w_note", height=80)
-    st.divider()
-
-    st.subheader("2. Entreprise")
-    st.text_input("Nom Entreprise", key="w_ent")
-    col_s1, col_s2 = st.columns([3, 1])
-    col_s1.text_input("Recherche SIRET", key="w_siret_input", label_visibility="collapsed", max_chars=14)
-    col_s2.button("🔍", on_click=auto_fill_siret)
-    st.text_input("Adresse Siège", key="w_kbis")
-    st.checkbox("Adresse travaux identique ?", key="w_checkbox_same", on_change=auto_copy_address)
-    st.text_input("Adresse Travaux", key="w_travaux")
-    st.text_input("SIRET Validé", key="w_siret_valide", max_chars=14)
-    st.divider()
-
-    st.subheader("3. Technique")
-    st.number_input("Superficie (m²)", min_value=0.0, step=1.0, format="%.0f", key="w_surf")
-    st.number_input("Hauteur ss plafond (m)", min_value=0.0, step=0.1, format="%.2f", key="w_haut")
-    st.text_input("Type Éclairage", key="w_ecl_type")
-    st.number_input("Puissance (W)", min_value=0, step=1, key="w_ecl_puis")
-    st.divider()
-
-    st.subheader("4. Comptage")
-    cc1, cc2 = st.columns(2)
-    cc1.number_input("Nb Actuel", min_value=0, step=1, key="w_nbecl")
-    cc2.number_input("Nb LEDs Préco", min_value=0, step=1, key="w_nbled")
-    st.divider()
-    
-    st.subheader("5. Fichiers (Catégories)")
-    # UPLOADERS AVEC CLE DYNAMIQUE POUR LE RESET
-    uk = st.session_state['uploader_key']
-    up_devis = st.file_uploader("1. Devis Signé", accept_multiple_files=True, key=f"up_devis_{uk}")
-    up_geo = st.file_uploader("2. Captures Géoportail", accept_multiple_files=True, key=f"up_geo_{uk}")
-    up_photos = st.file_uploader("3. Photos Local/Bâtiment", accept_multiple_files=True, key=f"up_photos_{uk}")
-    up_supp = st.file_uploader("4. Pièces Supplémentaires", accept_multiple_files=True, key=f"up_supp_{uk}")
-
-    if st.button("✅ Enregistrer la fiche", type="primary"):
-        nom_in = st.session_state.get("w_nom")
-        if not nom_in: st.error("Nom obligatoire.")
-        elif not is_valid_email(st.session_state.get("w_email")): st.error("Email invalide.")
-        else:
-            surf_val = str(st.session_state.get("w_surf")) if st.session_state.get("w_surf") > 0 else ""
-            haut_val = str(st.session_state.get("w_haut")) if st.session_state.get("w_haut") > 0 else ""
-            puis_val = str(st.session_state.get("w_ecl_puis")) if st.session_state.get("w_ecl_puis") > 0 else ""
-            
-            caracs = {"Superficie (m²)": surf_val, "Hauteur (m)": haut_val, "Type Éclairage": st.session_state.get("w_ecl_type"), "Puissance (W)": puis_val}
-            data_client = {
-                "nom": nom_in, "prenom": st.session_state.get("w_prenom"), "entreprise": st.session_state.get("w_ent"),
-                "siret": st.session_state.get("w_siret_valide"), "email": st.session_state.get("w_email"),
-                "telephone": re.sub(r'[\s\-\.]', '', st.session_state.get("w_tel") or ""),
-                "adresse_kbis": st.session_state.get("w_kbis"), "adresse_travaux": st.session_state.get("w_travaux"),
-                "nb_eclairage": st.session_state.get("w_nbecl"), "nb_leds_preconise": st.session_state.get("w_nbled"),
-                "note": st.session_state.get("w_note"), "caracteristiques": caracs
-            }
-            
-            uploads_dict = {
-                "Devis Signé": up_devis,
-                "Captures Géoportail": up_geo,
-                "Photos Local": up_photos,
-                "Pièces Supplémentaires": up_supp
-            }
-            
-            ajouter_client(data_client, uploads_dict)
-            st.session_state['reset_needed'] = True
-            st.session_state['uploader_key'] += 1 # On change la clé pour vider les champs
-            st.success("Sauvegardé !")
-            st.session_state['refresh'] = True
-            st.rerun()
-
-# --- TABS ---
-tab1, tab2 = st.tabs(["📊 Tableau de Bord", "📁 Gestion"])
-
-with tab1:
-    st.title("Suivi Clients (Cloud)")
-    search = st.text_input("Filtrer...", placeholder="Nom, Ville...")
-    if 'refresh' not in st.session_state: st.session_state['refresh'] = False
-    
-    df = get_dataframe(search)
-    st.session_state['df_view'] = df
-
-    if not df.empty:
-        col_conf = {"Statut": st.column_config.SelectboxColumn(options=["Nouveau", "Contacté", "Devis envoyé", "En négo", "Signé", "Perdu"], required=True)}
-        st.data_editor(df, column_config=col_conf, disabled=[c for c in df.columns if c != "Statut"], hide_index=True, use_container_width=True, height=600, key="main_editor", on_change=update_from_editor)
-    else: st.info("Vide.")
-
-with tab2:
-    st.header("Gestion Avancée")
-    all_clients = session.query(ClientModel).all()
-    opts = {c.id: f"{c.nom} {c.prenom or ''} ({c.entreprise or 'Indiv'})" for c in all_clients}
-    sel_id = st.selectbox("Sélectionner le client à gérer :", options=opts.keys(), format_func=lambda x: opts[x]) if opts else None
-    
-    if sel_id:
-        c_edit = session.query(ClientModel).get(sel_id)
-        
-        with st.expander("Modifier les informations", expanded=False):
-            with st.form("edit_form"):
-                e_nom = st.text_input("Nom", value=c_edit.nom or "")
-                e_pre = st.text_input("Prénom", value=c_edit.prenom or "")
-                e_email = st.text_input("Email", value=c_edit.email or "")
-                e_tel = st.text_input("Tél", value=c_edit.telephone or "")
-                e_ent = st.text_input("Entreprise", value=c_edit.entreprise or "")
-                e_siret = st.text_input("SIRET", value=c_edit.siret or "")
-                e_kbis = st.text_input("Adresse Siège", value=c_edit.adresse_kbis or "")
-                e_trav = st.text_input("Adresse Travaux", value=c_edit.adresse_travaux or "")
-                
-                # DATA TECHNIQUE
-                caracs_edit = {}
-                if c_edit.caracteristiques_json:
-                    try: caracs_edit = json.loads(c_edit.caracteristiques_json)
-                    except: pass
-                
-                def get_float(k):
-                    try: return float(caracs_edit.get(k, 0))
-                    except: return 0.0
-                def get_int(k):
-                    try: return int(float(k))
-                    except: return 0
-                
-                st.subheader("Technique & Comptage")
-                c_tech1, c_tech2 = st.columns(2)
-                e_surf = c_tech1.number_input("Superficie (m²)", value=get_float("Superficie (m²)"), step=1.0)
-                e_haut = c_tech2.number_input("Hauteur (m)", value=get_float("Hauteur (m)"), step=0.1)
-                e_type = st.text_input("Type Éclairage", value=caracs_edit.get("Type Éclairage", ""))
-                e_puis = st.number_input("Puissance (W)", value=int(float(caracs_edit.get("Puissance (W)", 0))), step=1)
-                
-                c_cpt1, c_cpt2 = st.columns(2)
-                e_nb = c_cpt1.number_input("Nb Actuel", value=get_int(c_edit.nb_eclairage))
-                e_nb_led = c_cpt2.number_input("Nb LEDs Préco", value=get_int(c_edit.nb_leds_preconise))
-
-                e_note = st.text_area("Note", value=c_edit.note or "")
-                
-                if st.form_submit_button("💾 Mettre à jour"):
-                    c_edit.nom = e_nom; c_edit.prenom = e_pre; c_edit.email = e_email; c_edit.telephone = e_tel
-                    c_edit.entreprise = e_ent; c_edit.siret = e_siret; c_edit.adresse_kbis = e_kbis
-                    c_edit.adresse_travaux = e_trav; c_edit.note = e_note
-                    c_edit.nb_eclairage = str(e_nb); c_edit.nb_leds_preconise = str(e_nb_led)
-                    
-                    new_caracs = {
-                        "Superficie (m²)": str(e_surf) if e_surf else "",
-                        "Hauteur (m)": str(e_haut) if e_haut else "",
-                        "Type Éclairage": e_type,
-                        "Puissance (W)": str(e_puis) if e_puis else ""
-                    }
-                    c_edit.caracteristiques_json = json.dumps(new_caracs)
-                    
+# --- IMPORT EN MASSE ---
+# En-têtes acceptés (libellés du tableau de bord ou noms de colonnes) -> champ ClientModel
+COLONNES_IMPORT = {
+    "Nom": "nom", "Prénom": "prenom", "Entreprise": "entreprise", "SIRET": "siret",
+    "Adresse KBIS": "adresse_kbis", "Adresse Travaux": "adresse_travaux", "Email": "email",
+    "Téléphone": "telephone", "Note": "note", "Nb Éclairages": "nb_eclairage",
+    "Nb LEDs": "nb_leds_preconise", "Statut": "statut", "Superficie (m²)": "superficie_m2",
+    "Hauteur (m)": "hauteur_m", "Type Éclairage": "type_eclairage", "Puissance (W)": "puissance_w"
+}
+STATUTS_IMPORT = {normaliser_recherche(s): s for s in STATUTS}  # Statut reconnu sans tenir compte de la casse ni des accents
+CHAMPS_NUMERIQUES_IMPORT = {"nb_eclairage": "Int64", "nb_leds_preconise": "Int64", "superficie_m2": "float", "hauteur_m": "float", "puissance_w": "Int64"}
+IMPORT_TAILLE_LOT = int(_conf("import", "taille_lot", 2000))
+
+def _champs_import(entetes):
+    par_libelle = {normaliser_recherche(k): v for k, v in COLONNES_IMPORT.items()}
+    champs_modele = set(COLONNES_IMPORT.values())
+    champs = {}
+    for entete in entetes:
+        cle = normaliser_recherche(str(entete))
+        champs[entete] = par_libelle.get(cle) or (cle.replace(" ", "_") if cle.replace(" ", "_") in champs_modele else None)
+    return champs
+
+def _lire_par_lots(fichier, nom_fichier, taille_lot):
+    """Itère sur (DataFrame de chaînes, fraction lue) sans charger tout le fichier."""
+    if nom_fichier.lower().endswith(".xlsx"):
+        from openpyxl import load_workbook
+        classeur = load_workbook(fichier, read_only=True, data_only=True)
+        feuille = classeur.active
+        lignes = feuille.iter_rows(values_only=True)
+        entetes = [str(e) if e is not None else "" for e in next(lignes, [])]
+        total, lot, lus = max(feuille.max_row or 1, 1), [], 0
+        for ligne in lignes:
+            lot.append(["" if v is None else str(v) for v in ligne])
+            if len(lot) == taille_lot:
+                lus += len(lot)
+                yield pd.DataFrame(lot, columns=entetes), min(lus / total, 1.0)  # max_row absent ou faux si la feuille n'a pas de dimension
+                lot = []
+        if lot: yield pd.DataFrame(lot, columns=entetes), 1.0
+        classeur.close()
+        return
+
+    fichier.seek(0, os.SEEK_END)
+    taille = max(fichier.tell(), 1)
+    fichier.seek(0)
+    extrait = fichier.read(4096).decode("utf-8-sig", errors="replace")
+    fichier.seek(0)
+    try: sep = csv.Sniffer().sniff(extrait, delimiters=",;\t").delimiter
+    except csv.Error: sep = ","
+    lecteur = pd.read_csv(fichier, sep=sep, dtype=str, keep_default_na=False, chunksize=taille_lot, encoding="utf-8-sig", encoding_errors="replace")
+    for lot in lecteur:
+        yield lot, min(fichier.tell() / taille, 1.0)
+
+def _valider_lot(lot, champs):
+    """Validation vectorisée : renvoie (lignes valides au format ClientModel, lignes rejetées avec motif)."""
+    df = pd.DataFrame({champ: lot[entete].str.strip() for entete, champ in champs.items() if champ})
+    for champ in COLONNES_IMPORT.values():
+        if champ not in df: df[champ] = ""
+    df["telephone"] = df["telephone"].str.replace(REGEX_SEPARATEURS_TEL, "", regex=True)
+    erreurs = pd.Series("", index=df.index)
+    erreurs = erreurs.mask(df["nom"] == "", erreurs + "Nom obligatoire; ")
+    erreurs = erreurs.mask((df["email"] != "") & ~df["email"].str.match(REGEX_EMAIL), erreurs + "Email invalide; ")
+    erreurs = erreurs.mask((df["telephone"] != "") & ~df["telephone"].str.match(REGEX_TELEPHONE), erreurs + "Téléphone invalide; ")
+    statuts = df["statut"].map(normaliser_recherche).map(STATUTS_IMPORT)
+    erreurs = erreurs.mask((df["statut"] != "") & statuts.isna(), erreurs + f"Statut inconnu (attendu : {', '.join(STATUTS)}); ")
+    df["statut"] = statuts.fillna("")
+    nombres = {}
+    for champ, type_num in CHAMPS_NUMERIQUES_IMPORT.items():
+        nombres[champ] = pd.to_numeric(df[champ].str.replace(",", ".", regex=False).replace("", None), errors="coerce")
+        libelle = next(k for k, v in COLONNES_IMPORT.items() if v == champ)
+        erreurs = erreurs.mask((df[champ] != "") & nombres[champ].isna(), erreurs + f"{libelle} non numérique; ")
+    rejet = erreurs != ""
+    rejetes = lot[rejet].assign(Erreur=erreurs[rejet].str.rstrip("; "))
+    for champ, type_num in CHAMPS_NUMERIQUES_IMPORT.items():
+        df[champ] = (nombres[champ].round() if type_num == "Int64" else nombres[champ]).astype(type_num)
+    valides = df[~rejet].astype(object)
+    valides = valides.where((valides != "") & valides.notna(), None)
+    valides["statut"] = valides["statut"].fillna("Nouveau")
+    return valides, rejetes
+
+def _completer_par_siret(lignes):
+    """Remplit entreprise et adresse du siège manquantes depuis le SIRET (résolution par lot), renvoie le nb de lignes complétées."""
+    a_completer = [l for l in lignes if l["siret"] and not (l["entreprise"] and l["adresse_kbis"])]
+    if not a_completer: return 0
+    infos, completes = resoudre_sirets([l["siret"] for l in a_completer]), 0
+    for ligne in a_completer:
+        trouve = infos.get(nettoyer_siret(ligne["siret"]))
+        if not trouve: continue
+        ligne["entreprise"] = ligne["entreprise"] or trouve["nom_complet"]
+        ligne["adresse_kbis"] = ligne["adresse_kbis"] or trouve["adresse"]
+        completes += 1
+    return completes
+
+def importer_clients(fichier, nom_fichier, progression=None, taille_lot=IMPORT_TAILLE_LOT, completer_siret=False):
+    """Importe un CSV/XLSX par lots : validation vectorisée, un INSERT multi-lignes par lot.
+
+    Les lignes rejetées sont écrites au fil de l'eau dans un CSV (chemin renvoyé dans "rapport").
+    completer_siret : entreprise et adresse du siège manquantes complétées via l'API SIRET (débit limité).
+    """
+    resume = {"inseres": 0, "rejetes": 0, "completes": 0, "rapport": None}
+    rapport = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False, encoding="utf-8-sig", newline="")
+    resume["rapport"] = rapport.name
+    champs, debut_ligne = None, 2  # ligne 1 = en-têtes
+    try:
+        with rapport:
+            for lot, fraction in _lire_par_lots(fichier, nom_fichier, taille_lot):
+                if champs is None:
+                    champs = _champs_import(lot.columns)
+                    if "nom" not in champs.values(): raise ValueError("Colonne « Nom » introuvable dans le fichier.")
+                lot.index = range(debut_ligne, debut_ligne + len(lot))
+                debut_ligne += len(lot)
+                valides, rejetes = _valider_lot(lot, champs)
+
+                if len(valides):
+                    lignes, deltas = valides.to_dict("records"), {}
+                    if completer_siret: resume["completes"] += _completer_par_siret(lignes)
+                    for ligne in lignes:
+                        ligne["search_document"] = document_recherche(SimpleNamespace(**ligne))
+                        ajouter_contribution_kpi(deltas, ligne["statut"], ligne["nb_eclairage"], ligne["nb_leds_preconise"], ligne["puissance_w"])
+                    session.execute(insert(ClientModel), lignes)
+                    appliquer_deltas_kpi(deltas)
                     session.commit()
-                    st.success("Mis à jour")
-                    st.session_state['refresh'] = True
-                    st.rerun()
+                if len(rejetes):
+                    rejetes.rename_axis("Ligne").to_csv(rapport, header=resume["rejetes"] == 0)
+                resume["inseres"] += len(valides)
+                resume["rejetes"] += len(rejetes)
+                if progression: progression(fraction, resume)
+    except Exception:
+        supprimer_rapport_import(resume)
+        raise
+    finally:
+        if resume["inseres"]: marquer_modification()  # Lots déjà validés, même si la suite échoue
+    if not resume["rejetes"]: supprimer_rapport_import(resume)
+    return resume
+
+def supprimer_rapport_import(resume):
+    # Rapport des rejets : fichier temporaire supprimé dès qu'il n'est plus proposé au téléchargement
+    if resume and resume.get("rapport"):
+        try: os.remove(resume["rapport"])
+        except FileNotFoundError: pass
+        resume["rapport"] = None
+
+# --- TACHES DE FOND ---
+LIBELLES_JOBS = {"pdf": "Dossier PDF", "upload": "Envoi de fichiers", "suppression_client": "Suppression du client",
+                 "purge_stockage": "Nettoyage du stockage", "reconciliation": "Réconciliation du stockage"}
+
+@st.cache_resource
+def get_executeur_jobs():
+    # Un pool par process ; les tâches interrompues par un redémarrage sont marquées en échec
+    with get_engine().begin() as conn:
+        conn.execute(JobModel.__table__.update().where(JobModel.statut.in_(["en_attente", "en_cours"]))
+                     .values(statut="echec", message="Interrompue (redémarrage de l'application)", maj_le=_maintenant()))
+    return ThreadPoolExecutor(max_workers=JOBS_WORKERS, thread_name_prefix="crm-job")
+
+def _maj_job(job_id, **valeurs):
+    # Transaction courte et indépendante de la session de la tâche
+    with get_engine().begin() as conn:
+        conn.execute(JobModel.__table__.update().where(JobModel.id == job_id).values(maj_le=_maintenant(), **valeurs))
+
+def _executer_job(job_id, type_job, fonction, args):
+    debut_mesure(f"job:{type_job}")
+    dernier = [0.0]
+    def progression(fraction, message=None):
+        if time.monotonic() - dernier[0] < 0.5 and fraction < 1: return  # Au plus 2 écritures/s
+        dernier[0] = time.monotonic()
+        _maj_job(job_id, progression=fraction, message=str(message) if message is not None else None)
+    try:
+        _maj_job(job_id, statut="en_cours")
+        resultat = fonction(*args, progression=progression)
+        _maj_job(job_id, statut="termine", progression=1, message=None, resultat=json.dumps(resultat, default=str))
+    except Exception as e:
+        session.rollback()
+        _maj_job(job_id, statut="echec", message=f"{type(e).__name__}: {e}")
+    finally:
+        fin_de_rerun()
+
+def soumettre_job(type_job, client_id, fonction, *args):
+    """Exécute fonction(*args, progression=...) dans le pool de fond, renvoie l'identifiant du job.
+
+    La fonction s'exécute dans un autre thread, donc avec sa propre session.
+    """
+    job_id = uuid.uuid4().hex
+    executeur = get_executeur_jobs()
+    with get_engine().begin() as conn:
+        maintenant = _maintenant()
+        conn.execute(JobModel.__table__.insert().values(id=job_id, type=type_job, client_id=client_id, statut="en_attente",
+                                                        progression=0, cree_le=maintenant, maj_le=maintenant))
+    executeur.submit(_executer_job, job_id, type_job, fonction, args)
+    return job_id
+
+def lire_jobs(ids):
+    # Pas de limite : chaque job suivi doit être relu, sinon il resterait suivi indéfiniment
+    jobs = [_instantane(j) for j in session.query(JobModel).filter(JobModel.id.in_(ids)).order_by(JobModel.cree_le.desc())]
+    session.commit()  # Fin de la transaction de lecture : le prochain rafraîchissement voit les mises à jour
+    for job in jobs: job.resultat = json.loads(job.resultat) if job.resultat else None
+    return jobs
+
+def _job_suppression_client(client_id, progression=None):
+    supprimer_client_entier(client_id)
+    return purger_suppressions(progression=progression)
+
+def nettoyer_jobs():
+    """Supprime les jobs terminés ou en échec depuis plus de JOBS_RETENTION. Renvoie le nombre supprimé."""
+    supprimes = session.query(JobModel).filter(JobModel.statut.in_(("termine", "echec")),
+                                               JobModel.maj_le < _maintenant() - JOBS_RETENTION).delete(synchronize_session=False)
+    session.commit()
+    return supprimes
+
+def demander_purge():
+    # Une seule purge en attente à la fois : elle traitera toutes les suppressions dues
+    if not session.query(JobModel.id).filter_by(type="purge_stockage", statut="en_attente").first():
+        soumettre_job("purge_stockage", None, purger_suppressions)
+
+@st.cache_resource
+def get_planificateur():
+    """Thread de fond : relance les suppressions échouées, nettoie les anciens jobs et réconcilie périodiquement le bucket."""
+    def boucle():
+        prochaine_reconciliation = _maintenant() + RECONCILIATION_INTERVALLE
+        while True:
+            time.sleep(PURGE_INTERVALLE)
+            try:
+                if session.query(SuppressionEnAttenteModel.path).filter(SuppressionEnAttenteModel.prochaine_tentative <= _maintenant()).first():
+                    demander_purge()
+                nettoyer_jobs()
+                if RECONCILIATION_INTERVALLE and _maintenant() >= prochaine_reconciliation:
+                    soumettre_job("reconciliation", None, reconcilier_stockage)
+                    prochaine_reconciliation = _maintenant() + RECONCILIATION_INTERVALLE
+            except Exception:
+                journal.exception("Planificateur : échec de la relance des suppressions, du nettoyage des jobs ou de la réconciliation")
+            finally:
+                fin_de_rerun()
+    planificateur = threading.Thread(target=boucle, name="crm-planificateur", daemon=True)
+    planificateur.start()
+    return planificateur
+
+def suivre_job(job_id):
+    # Jobs lancés depuis cette session : suivis tant qu'ils tournent, un rerun complet est déclenché à leur fin
+    st.session_state.setdefault('jobs_suivis', []).append(job_id)
+
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None)
+
+def _rafraichi(fonction):
+    # Rafraîchissement périodique de la zone seule, si la version de Streamlit le permet
+    return _fragment(run_every=JOBS_RAFRAICHISSEMENT)(fonction) if _fragment else fonction
+
+def _afficher_job(job, nom_client=""):
+    libelle = LIBELLES_JOBS.get(job.type, job.type)
+    if job.statut in ("en_attente", "en_cours"):
+        st.progress(min(job.progression or 0, 1.0), text=f"⏳ {libelle} — {job.message or job.statut.replace('_', ' ')}")
+    elif job.statut == "echec":
+        st.error(f"{libelle} : échec — {job.message}")
+    elif job.type == "pdf" and job.resultat and os.path.exists(job.resultat):
+        # Limite de Streamlit : download_button lit le fichier entier en mémoire (.read())
+        with open(job.resultat, "rb") as pdf_file:
+            st.download_button("⬇️ Télécharger le Dossier Fusionné (.pdf)", data=pdf_file, file_name=f"Dossier_Complet_{nom_client}.pdf",
+                               mime="application/pdf", key=f"dl_{job.id}")
+    elif job.type == "pdf":
+        st.warning("Dossier PDF indisponible (aucun document fusionnable ou cache expiré) : relancer la génération.")
+    else:
+        details = ", ".join(f"{cle} : {valeur}" for cle, valeur in job.resultat.items() if not isinstance(valeur, list)) if isinstance(job.resultat, dict) else ""
+        st.caption(f"✅ {libelle} terminé(e)" + (f" — {details}" if details else ""))
+
+def afficher_jobs():
+    # Aucune requête ni rafraîchissement périodique tant qu'aucune tâche de cette session ne tourne :
+    # la zone rafraîchie n'est rendue (et son minuteur actif) que pendant le suivi
+    if st.session_state.get('jobs_suivis'): _afficher_jobs_en_cours()
+
+@_rafraichi
+def _afficher_jobs_en_cours():
+    # Tâches lancées depuis cette session (envois, dossiers PDF, suppressions)
+    suivis = st.session_state.get('jobs_suivis', [])
+    if not suivis: return
+    jobs = lire_jobs(suivis)
+    disparus = set(suivis) - {j.id for j in jobs}  # Ligne supprimée (nettoyage des jobs) : plus rien à suivre
+    termines = [j for j in jobs if j.id in suivis and j.statut in ("termine", "echec")]
+    for job in jobs:
+        if job not in termines: _afficher_job(job)
+    if termines or disparus:
+        suivis[:] = [i for i in suivis if i not in disparus]
+        for job in termines:
+            if job.id in suivis: suivis.remove(job.id)
+            if job.type == "upload" and job.resultat: st.session_state['rapport_upload'] = job.resultat
+            if job.type == "pdf": st.session_state.setdefault('dossiers_pdf', {})[job.client_id] = job
+        st.rerun()  # Tableau de bord et fiches à jour une fois la tâche terminée
+
+def afficher_dossier_pdf(client_id, nom_client):
+    # Dernière génération terminée dans cette session : gardée en session, affichée sans requête ni minuteur
+    job = st.session_state.get('dossiers_pdf', {}).get(client_id)
+    if job: _afficher_job(job, nom_client)
+
+# --- INTERFACE ---
+def main():
+    st.set_page_config(page_title="CRM V19 - Auto Clear", layout="wide")
+    if not DATABASE_URL:
+        st.error("Secrets introuvables.")
+        st.stop()
+    try: initialiser_base()
+    except SchemaNonAJour as e:
+        st.error(str(e))
+        st.stop()
+    get_planificateur()
+    if 'reset_needed' not in st.session_state: st.session_state['reset_needed'] = False
+    if 'uploader_key' not in st.session_state: st.session_state['uploader_key'] = 0
+    clear_form_logic() 
+    afficher_rapport_upload()
+    afficher_jobs()
+
+    with st.sidebar:
+        st.header("Nouveau Client")
+        st.subheader("1. Contact")
+        c_nom, c_prenom = st.columns(2)
+        c_nom.text_input("Nom *", key="w_nom")
+        c_prenom.text_input("Prénom", key="w_prenom")
+        st.text_input("Mail", key="w_email")
+        st.text_input("Téléphone", key="w_tel")
+        st.text_area("Note (Interne)", key="w_note", height=80)
+        st.divider()
+
+        st.subheader("2. Entreprise")
+        st.text_input("Nom Entreprise", key="w_ent")
+        col_s1, col_s2 = st.columns([3, 1])
+        col_s1.text_input("Recherche SIRET", key="w_siret_input", label_visibility="collapsed", max_chars=14)
+        col_s2.button("🔍", on_click=auto_fill_siret)
+        st.text_input("Adresse Siège", key="w_kbis")
+        st.checkbox("Adresse travaux identique ?", key="w_checkbox_same", on_change=auto_copy_address)
+        st.text_input("Adresse Travaux", key="w_travaux")
+        st.text_input("SIRET Validé", key="w_siret_valide", max_chars=14)
+        st.divider()
+
+        st.subheader("3. Technique")
+        st.number_input("Superficie (m²)", min_value=0.0, step=1.0, format="%.0f", key="w_surf")
+        st.number_input("Hauteur ss plafond (m)", min_value=0.0, step=0.1, format="%.2f", key="w_haut")
+        st.text_input("Type Éclairage", key="w_ecl_type")
+        st.number_input("Puissance (W)", min_value=0, step=1, key="w_ecl_puis")
+        st.divider()
 
+        st.subheader("4. Comptage")
+        cc1, cc2 = st.columns(2)
+        cc1.number_input("Nb Actuel", min_value=0, step=1, key="w_nbecl")
+        cc2.number_input("Nb LEDs Préco", min_value=0, step=1, key="w_nbled")
         st.divider()
-        st.subheader("Fichiers & Fusion")
-        
-        is_complet = verifier_categories_completes(c_edit.id)
-        if is_complet:
-            st.success("🌟 Dossier complet ! (Devis + Géoportail + Photos présents)")
-            if st.button("📑 GÉNÉRER ET TÉLÉCHARGER LE DOSSIER PDF COMPLET"):
-                with st.spinner("Fusion des documents et images en cours..."):
-                    pdf_bytes = generer_pdf_fusionne(c_edit.id)
-                    if pdf_bytes:
-                        st.download_button(
-                            label="⬇️ Télécharger le Dossier Fusionné (.pdf)",
-                            data=pdf_bytes,
-                            file_name=f"Dossier_Complet_{c_edit.nom}.pdf",
-                            mime="application/pdf"
-                        )
+
+        st.subheader("5. Fichiers (Catégories)")
+        # UPLOADERS AVEC CLE DYNAMIQUE POUR LE RESET
+        uk = st.session_state['uploader_key']
+        up_devis = st.file_uploader("1. Devis Signé", accept_multiple_files=True, key=f"up_devis_{uk}")
+        up_geo = st.file_uploader("2. Captures Géoportail", accept_multiple_files=True, key=f"up_geo_{uk}")
+        up_photos = st.file_uploader("3. Photos Local/Bâtiment", accept_multiple_files=True, key=f"up_photos_{uk}")
+        up_supp = st.file_uploader("4. Pièces Supplémentaires", accept_multiple_files=True, key=f"up_supp_{uk}")
+
+        if st.button("✅ Enregistrer la fiche", type="primary"):
+            nom_in = st.session_state.get("w_nom")
+            if not nom_in: st.error("Nom obligatoire.")
+            elif not is_valid_email(st.session_state.get("w_email")): st.error("Email invalide.")
+            else:
+                data_client = {
+                    "nom": nom_in, "prenom": st.session_state.get("w_prenom"), "entreprise": st.session_state.get("w_ent"),
+                    "siret": st.session_state.get("w_siret_valide"), "email": st.session_state.get("w_email"),
+                    "telephone": re.sub(r'[\s\-\.]', '', st.session_state.get("w_tel") or ""),
+                    "adresse_kbis": st.session_state.get("w_kbis"), "adresse_travaux": st.session_state.get("w_travaux"),
+                    "nb_eclairage": st.session_state.get("w_nbecl"), "nb_leds_preconise": st.session_state.get("w_nbled"),
+                    "note": st.session_state.get("w_note"),
+                    "superficie_m2": st.session_state.get("w_surf") or None, "hauteur_m": st.session_state.get("w_haut") or None,
+                    "type_eclairage": st.session_state.get("w_ecl_type") or None, "puissance_w": st.session_state.get("w_ecl_puis") or None
+                }
+
+                uploads_dict = {
+                    "Devis Signé": up_devis,
+                    "Captures Géoportail": up_geo,
+                    "Photos Local": up_photos,
+                    "Pièces Supplémentaires": up_supp
+                }
+
+                client_id = ajouter_client(data_client)
+                if any(uploads_dict.values()):
+                    suivre_job(soumettre_job("upload", client_id, sauvegarder_categories, client_id, uploads_dict))
+                st.session_state['reset_needed'] = True
+                st.session_state['uploader_key'] += 1 # On change la clé pour vider les champs
+                st.success("Sauvegardé !")
+                st.rerun()
+
+    # --- TABS ---
+    tab1, tab2, tab3 = st.tabs(["📊 Tableau de Bord", "📁 Gestion", "📥 Import"])
+
+    with tab1:
+        st.title("Suivi Clients (Cloud)")
+        kpi = get_cache().lire("lire_kpi", lire_kpi)
+        total_kpi = sum(k["nb_clients"] for k in kpi.values())
+        signes, perdus = kpi.get("Signé", {}).get("nb_clients", 0), kpi.get("Perdu", {}).get("nb_clients", 0)
+        puissance_actuelle = sum(k["puissance_actuelle_w"] for k in kpi.values())
+        nb_leds = sum(k["nb_leds"] for k in kpi.values())
+        cols_kpi = st.columns(len(STATUTS))
+        for col, statut in zip(cols_kpi, STATUTS):
+            col.metric(statut, kpi.get(statut, {}).get("nb_clients", 0))
+        k1, k2, k3, k4 = st.columns(4)
+        k1.metric("Taux de signature", f"{signes / total_kpi:.1%}" if total_kpi else "—", help="Signés / total des clients")
+        k2.metric("Conversion (dossiers clos)", f"{signes / (signes + perdus):.1%}" if signes + perdus else "—", help="Signés / (Signés + Perdus)")
+        k3.metric("Éclairages actuels → LEDs", f"{sum(k['nb_eclairage'] for k in kpi.values())} → {nb_leds}")
+        k4.metric("Économie estimée", f"{max(puissance_actuelle - nb_leds * PUISSANCE_LED_W, 0) / 1000:.1f} kW",
+                  help=f"Σ(nb éclairages × puissance) − Σ(LEDs préconisées) × {PUISSANCE_LED_W:g} W")
+        search = st.text_input("Filtrer...", placeholder="Nom, ville, SIRET, email, téléphone, note...")
+        with st.expander("Filtres & tri"):
+            f_statuts = st.multiselect("Statut", STATUTS)
+            cf1, cf2, cf3, cf4 = st.columns(4)
+            f_surf_min = cf1.number_input("Surface min (m²)", min_value=0.0, step=50.0)
+            f_surf_max = cf2.number_input("Surface max (m²)", min_value=0.0, step=50.0, help="0 = sans limite")
+            f_puis_min = cf3.number_input("Puissance min (W)", min_value=0, step=100)
+            f_puis_max = cf4.number_input("Puissance max (W)", min_value=0, step=100, help="0 = sans limite")
+            ct1, ct2 = st.columns([3, 1])
+            tri = ct1.selectbox("Trier par", list(COLONNES_TRI))
+            decroissant = ct2.checkbox("Décroissant")
+        filtres = (("statuts", tuple(f_statuts)), ("surface_min", f_surf_min), ("surface_max", f_surf_max),
+                   ("puissance_min", f_puis_min), ("puissance_max", f_puis_max))
+        cache = get_cache()
+        col_taille, col_page, col_total = st.columns([1, 1, 2])
+        taille_page = col_taille.selectbox("Lignes par page", TAILLES_PAGE, index=TAILLES_PAGE.index(TAILLE_PAGE_DEFAUT) if TAILLE_PAGE_DEFAUT in TAILLES_PAGE else 0)
+        total = cache.lire("compter_clients", compter_clients, search, filtres)
+        nb_pages = max(1, -(-total // taille_page))
+        if st.session_state.get('page_dashboard', 1) > nb_pages: st.session_state['page_dashboard'] = nb_pages
+        page = col_page.number_input("Page", min_value=1, max_value=nb_pages, step=1, key="page_dashboard")
+        col_total.caption(f"{total} client(s) — page {page}/{nb_pages} · cache {cache.hits} hit(s) / {cache.misses} miss(es)")
+
+        df = cache.lire("get_dataframe", get_dataframe, search, page, taille_page, filtres, tri, decroissant)
+
+        if not df.empty:
+            col_conf = {"Statut": st.column_config.SelectboxColumn(options=STATUTS, required=True)}
+            # Clé propre à la page affichée : les modifications en attente ne glissent pas d'une page à l'autre
+            cle_editor = f"main_editor_{hash((search, filtres, tri, decroissant, taille_page, page))}"
+            st.data_editor(df, column_config=col_conf, disabled=[c for c in df.columns if c != "Statut"], hide_index=True, use_container_width=True, height=600, key=cle_editor, on_change=update_from_editor, args=(cle_editor, df["ID"].tolist()))
+            with st.expander("Action groupée"):
+                libelles = {r.ID: f"#{r.ID} {r.Nom or ''} ({r.Entreprise or 'Indiv'})" for r in df.itertuples()}
+                ca1, ca2, ca3 = st.columns([3, 1, 1])
+                selection = ca1.multiselect("Clients de la page", list(libelles), format_func=libelles.get)
+                if ca1.checkbox("Toute la page"): selection = list(libelles)
+                nouveau_statut = ca2.selectbox("Nouveau statut", STATUTS)
+                if ca3.button("Appliquer", disabled=not selection):
+                    nb = changer_statuts({int(i): nouveau_statut for i in selection})
+                    st.toast(f"{nb} client(s) passé(s) en « {nouveau_statut} »")
+                    st.rerun()
+        else: st.info("Vide.")
+
+    with tab2:
+        st.header("Gestion Avancée")
+        cs1, cs2 = st.columns([3, 1])
+        recherche_client = cs1.text_input("Rechercher un client", placeholder="Nom, entreprise, SIRET...", key="recherche_gestion")
+        nb_pages_sel = max(1, -(-get_cache().lire("compter_clients", compter_clients, recherche_client) // TAILLE_PAGE_SELECTEUR))
+        if st.session_state.get('page_gestion', 1) > nb_pages_sel: st.session_state['page_gestion'] = nb_pages_sel
+        page_sel = cs2.number_input(f"Page (/{nb_pages_sel})", min_value=1, max_value=nb_pages_sel, step=1, key="page_gestion")
+        opts = get_cache().lire("chercher_clients", chercher_clients, recherche_client, page_sel)
+        sel_id = st.selectbox("Sélectionner le client à gérer :", options=opts.keys(), format_func=lambda x: opts[x]) if opts else None
+
+        if sel_id:
+            c_edit = get_cache().lire("charger_fiche_client", charger_fiche_client, sel_id)
+
+            with st.expander("Modifier les informations", expanded=False):
+                with st.form("edit_form"):
+                    e_nom = st.text_input("Nom", value=c_edit.nom or "")
+                    e_pre = st.text_input("Prénom", value=c_edit.prenom or "")
+                    e_email = st.text_input("Email", value=c_edit.email or "")
+                    e_tel = st.text_input("Tél", value=c_edit.telephone or "")
+                    e_ent = st.text_input("Entreprise", value=c_edit.entreprise or "")
+                    e_siret = st.text_input("SIRET", value=c_edit.siret or "")
+                    e_kbis = st.text_input("Adresse Siège", value=c_edit.adresse_kbis or "")
+                    e_trav = st.text_input("Adresse Travaux", value=c_edit.adresse_travaux or "")
+
+                    # DATA TECHNIQUE
+                    st.subheader("Technique & Comptage")
+                    c_tech1, c_tech2 = st.columns(2)
+                    e_surf = c_tech1.number_input("Superficie (m²)", value=float(c_edit.superficie_m2 or 0), step=1.0)
+                    e_haut = c_tech2.number_input("Hauteur (m)", value=float(c_edit.hauteur_m or 0), step=0.1)
+                    e_type = st.text_input("Type Éclairage", value=c_edit.type_eclairage or "")
+                    e_puis = st.number_input("Puissance (W)", value=int(c_edit.puissance_w or 0), step=1)
+
+                    c_cpt1, c_cpt2 = st.columns(2)
+                    e_nb = c_cpt1.number_input("Nb Actuel", value=int(c_edit.nb_eclairage or 0))
+                    e_nb_led = c_cpt2.number_input("Nb LEDs Préco", value=int(c_edit.nb_leds_preconise or 0))
+
+                    e_note = st.text_area("Note", value=c_edit.note or "")
+
+                    if st.form_submit_button("💾 Mettre à jour"):
+                        modifier_client(c_edit.id, {
+                            "nom": e_nom, "prenom": e_pre, "email": e_email, "telephone": e_tel,
+                            "entreprise": e_ent, "siret": e_siret, "adresse_kbis": e_kbis,
+                            "adresse_travaux": e_trav, "note": e_note,
+                            "nb_eclairage": e_nb, "nb_leds_preconise": e_nb_led,
+                            "superficie_m2": e_surf or None, "hauteur_m": e_haut or None,
+                            "type_eclairage": e_type or None, "puissance_w": e_puis or None
+                        })
+                        st.success("Mis à jour")
+                        st.rerun()
+
+            with st.expander("Historique des statuts"):
+                historique = get_cache().lire("historique_statuts", historique_statuts, c_edit.id)
+                for change_le, ancien, nouveau in historique:
+                    st.caption(f"{change_le:%d/%m/%Y %H:%M} — {ancien or '∅'} → {nouveau}")
+                if not historique: st.caption("Aucun changement de statut enregistré.")
+
+            st.divider()
+            st.subheader("Fichiers & Fusion")
+
+            comptes = get_cache().lire("compter_fichiers_par_categorie", compter_fichiers_par_categorie, c_edit.id)
+            is_complet = dossier_complet(comptes)
+            if is_complet:
+                st.success("🌟 Dossier complet ! (Devis + Géoportail + Photos présents)")
+                if st.button("📑 GÉNÉRER LE DOSSIER PDF COMPLET"):
+                    st.session_state.get('dossiers_pdf', {}).pop(c_edit.id, None)
+                    suivre_job(soumettre_job("pdf", c_edit.id, generer_pdf_fusionne, c_edit.id))
+                    st.rerun()
+                afficher_dossier_pdf(c_edit.id, c_edit.nom)
+            else:
+                st.info("💡 Dossier incomplet pour la fusion (Manque Devis, Géoportail ou Photos).")
+
+            # AFFICHAGE PAR CATEGORIES
+            uk = st.session_state['uploader_key'] # Recup clé dynamique
+
+            for cat in CATEGORIES:
+                # HEADER AVEC BOUTON SUPPRIMER TOUT
+                col_titre, col_del_all = st.columns([4, 1])
+                col_titre.markdown(f"### 📁 {cat} ({comptes.get(cat, 0)})")
+                if col_del_all.button("🗑 Tout supprimer", key=f"del_cat_{cat}", help=f"Supprime tous les fichiers de {cat}"):
+                     supprimer_categorie_entiere(c_edit.id, cat)
+                     demander_purge()
+                     st.rerun()
+
+                with st.expander(f"Voir/Ajouter fichiers dans {cat}", expanded=True):
+                    # Liste existante
+                    fichiers_cat = c_edit.fichiers_par_categorie.get(cat, [])
+                    if fichiers_cat:
+                        for f in fichiers_cat:
+                            c1, c2, c3 = st.columns([4, 2, 1])
+                            c1.text(f"📄 {f.nom_fichier}")
+                            if f.url_miniature: c2.markdown(f"[![{f.nom_fichier}]({f.url_miniature})]({f.url_public})")
+                            else: c2.markdown(f"[Voir]({f.url_public})")
+                            if c3.button("❌", key=f"d_{f.id}"):
+                                supprimer_un_fichier(f.id)
+                                demander_purge()
+                                st.rerun()
                     else:
-                        st.error("Erreur génération PDF.")
-        else:
-            st.info("💡 Dossier incomplet pour la fusion (Manque Devis, Géoportail ou Photos).")
-
-        # AFFICHAGE PAR CATEGORIES
-        categories_ordre = ["Devis Signé", "Captures Géoportail", "Photos Local", "Pièces Supplémentaires"]
-        uk = st.session_state['uploader_key'] # Recup clé dynamique
-        
-        for cat in categories_ordre:
-            # HEADER AVEC BOUTON SUPPRIMER TOUT
-            col_titre, col_del_all = st.columns([4, 1])
-            col_titre.markdown(f"### 📁 {cat}")
-            if col_del_all.button("🗑 Tout supprimer", key=f"del_cat_{cat}", help=f"Supprime tous les fichiers de {cat}"):
-                 supprimer_categorie_entiere(c_edit.id, cat)
-                 st.session_state['refresh'] = True
-                 st.rerun()
-
-            with st.expander(f"Voir/Ajouter fichiers dans {cat}", expanded=True):
-                # Liste existante
-                fichiers_cat = [f for f in c_edit.fichiers if f.categorie == cat]
-                if fichiers_cat:
-                    for f in fichiers_cat:
-                        c1, c2, c3 = st.columns([4, 2, 1])
-                        c1.text(f"📄 {f.nom_fichier}")
-                        c2.markdown(f"[Voir]({f.url_public})")
-                        if c3.button("❌", key=f"d_{f.id}"):
-                            supprimer_un_fichier(f.id)
-                            st.session_state['refresh'] = True
+                        st.caption("Aucun fichier.")
+
+                    # Upload rapide avec CLÉ DYNAMIQUE pour vidage auto
+                    add_files = st.file_uploader(f"Ajouter dans {cat}", accept_multiple_files=True, key=f"add_{cat}_{uk}")
+                    if add_files:
+                        if st.button(f"Envoyer vers {cat}", key=f"btn_{cat}"):
+                            suivre_job(soumettre_job("upload", c_edit.id, sauvegarder_fichiers, c_edit.id, add_files, cat))
+                            st.session_state['uploader_key'] += 1 # On vide les champs
                             st.rerun()
-                else:
-                    st.caption("Aucun fichier.")
-                
-                # Upload rapide avec CLÉ DYNAMIQUE pour vidage auto
-                add_files = st.file_uploader(f"Ajouter dans {cat}", accept_multiple_files=True, key=f"add_{cat}_{uk}")
-                if add_files:
-                    if st.button(f"Envoyer vers {cat}", key=f"btn_{cat}"):
-                        sauvegarder_fichiers(c_edit.id, add_files, cat)
-                        st.session_state['uploader_key'] += 1 # On vide les champs
-                        st.success("Envoyé !")
-                        st.session_state['refresh'] = True
-                        st.rerun()
 
-        st.divider()
-        if st.button("🗑 SUPPRIMER CLIENT", type="primary"):
-            supprimer_client_entier(c_edit.id)
-            st.session_state['refresh'] = True
-            st.rerun()
+            st.divider()
+            if st.button("🗑 SUPPRIMER CLIENT", type="primary"):
+                suivre_job(soumettre_job("suppression_client", c_edit.id, _job_suppression_client, c_edit.id))
+                st.rerun()
+
+    with tab3:
+        st.header("Import de clients (CSV / Excel)")
+        st.caption("En-têtes reconnus : " + ", ".join(COLONNES_IMPORT) + ". Seul « Nom » est obligatoire.")
+        fichier_import = st.file_uploader("Fichier à importer", type=["csv", "xlsx"], key=f"import_{st.session_state['uploader_key']}")
+        completer_siret = st.checkbox("Compléter entreprise et adresse du siège depuis le SIRET",
+                                      help=f"API Recherche Entreprises, au plus {SIRET_DEBIT_MAX:g} requêtes/s : à réserver aux fichiers de taille raisonnable.")
+        if fichier_import and st.button("📥 Lancer l'import", type="primary"):
+            barre = st.progress(0.0, text="Import en cours...")
+            try:
+                resume = importer_clients(fichier_import, fichier_import.name, completer_siret=completer_siret,
+                                          progression=lambda f, r: barre.progress(f, text=f"{r['inseres']} importé(s), {r['rejetes']} rejeté(s)"))
+                supprimer_rapport_import(st.session_state.get('resume_import'))
+                st.session_state['resume_import'] = resume
+            except ValueError as e: st.error(str(e))
+
+        resume = st.session_state.get('resume_import')
+        if resume:
+            st.success(f"{resume['inseres']} client(s) importé(s)." + (f" {resume['completes']} complété(s) depuis le SIRET." if resume.get('completes') else ""))
+            if resume['rejetes'] and resume['rapport'] and os.path.exists(resume['rapport']):
+                st.warning(f"{resume['rejetes']} ligne(s) rejetée(s).")
+                with open(resume['rapport'], "rb") as rapport:
+                    st.download_button("⬇️ Télécharger le rapport d'erreurs (.csv)", data=rapport, file_name="rejets_import.csv", mime="text/csv")
+
+    if PERF_ACTIF and est_admin_perf(): afficher_mesures()
+
+if __name__ == "__main__":
+    debut_mesure("rerun")
+    try: main()
+    finally: fin_de_rerun()
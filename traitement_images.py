@@ -0,0 +1,30 @@
+"""Normalisation des images à l'upload.
+
+Module séparé de mini_crm.py pour pouvoir être exécuté dans un pool de process
+(les fonctions doivent être importables par les process fils).
+"""
+import io
+
+EXTENSIONS_IMAGE = ('.png', '.jpg', '.jpeg', '.webp')
+
+def est_image(nom_fichier):
+    return nom_fichier.lower().endswith(EXTENSIONS_IMAGE)
+
+def normaliser_image(data, taille_max, qualite, taille_miniature):
+    """Renvoie (jpeg normalisé, miniature jpeg) à partir des octets d'une image.
+
+    Décodage réduit (draft JPEG), orientation EXIF appliquée, côté le plus long
+    limité à taille_max, ré-encodage JPEG à la qualité demandée.
+    """
+    from PIL import Image, ImageOps  # Import différé : est_image() ne doit pas charger Pillow
+    with Image.open(io.BytesIO(data)) as source:
+        source.draft("RGB", (taille_max, taille_max))
+        image = ImageOps.exif_transpose(source)
+        if image.mode != "RGB": image = image.convert("RGB")
+        image.thumbnail((taille_max, taille_max), Image.LANCZOS)
+        sortie = io.BytesIO()
+        image.save(sortie, "JPEG", quality=qualite, optimize=True, progressive=True)
+        image.thumbnail((taille_miniature, taille_miniature), Image.LANCZOS)
+        miniature = io.BytesIO()
+        image.save(miniature, "JPEG", quality=80)
+    return sortie.getvalue(), miniature.getvalue()